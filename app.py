@@ -1,15 +1,29 @@
 import streamlit as st
+import streamlit.components.v1 as components # Client-side essay countdown
 import google.generativeai as genai
+from google.api_core import retry as google_retry # Ships with google-generativeai
 import time
-from datetime import datetime, date
+from datetime import datetime
 import psycopg2 # For PostgreSQL
 import psycopg2.extras # For dictionary-like cursors
+import psycopg2.pool # For the shared connection pool
+import psycopg2.extensions # Base connection class for the pool's connection_factory
+from contextlib import contextmanager
 import json
-from werkzeug.security import generate_password_hash, check_password_hash
+import logging
+import re
+import orjson # Fast C JSON parser for Gemini responses
+import hashlib
+from werkzeug.security import check_password_hash # Verifies legacy (pre-argon2) password hashes
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import pandas as pd
+import altair as alt # Vega-Lite specs for the criteria chart
 import io
 from streamlit_quill import st_quill
-from markdownify import markdownify as md
+import html2text
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import uuid # For generating IDs if needed, though SERIAL PRIMARY KEY handles it
 
 # --- Page Configuration ---
@@ -20,6 +34,17 @@ st.set_page_config(
 )
 APP_LOGO_URL = "https://truskill.in/images/logo/logo.png"
 
+# --- Logging ---
+# Level-gated logging instead of print(): DEBUG records aren't even formatted at INFO, and the
+# handler stamps the time. The script body reruns on every interaction, so attach the handler once.
+logger = logging.getLogger("essay_app")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
 # --- Gemini API Key ---
 # We rely on st.secrets for deployment
 try:
@@ -28,306 +53,613 @@ except KeyError:
     st.error("🚨 Gemini API Key not found in Streamlit Secrets.")
     st.stop() # Critical failure, cannot proceed without API key
 
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel(model_name='gemini-1.5-flash-latest')
+# Static grading rubric, sent once as the model's system instruction instead of being
+# prepended to every essay prompt. Output is forced to JSON via response_mime_type.
+ESSAY_RUBRIC_INSTRUCTION = """
+You are an Excellent Writter and Copywrite Expert which has 20 years of experience in writing essays. You are specialized in evaluating student essays. You are given a Title and Essay in Markdown format by the user, Asses Students Essay in Right manner.
+
+Please assess the essay based on the following five criteria. For each, give a score from 0 to 100 (0 = very poor, 100 = excellent) and a brief justification:
+
+1. Grammar (20%): spelling, punctuation, sentence structure, mechanics of Writting.
+2. Relevancy and Cohesion with Title (25%): how well the content stays on topic mentioned  and flows logically relative to the title.
+3. Clarity and Content Development with respect to Title (25%): depth of ideas present in content, supporting evidence, originality, and clarity with relate to the title.
+4. Sentence Formation (20%): variety and complexity of sentence structures, conciseness.
+5. Formatting (10%): appropriate Markdown usage (headings, lists, blockquotes) and overall readability and Presentation.
+
+After scoring, also provide:
+- Overall Word Count
+- Overall Feedback: a concise summary (4 to 6 sentences) of the essays main strengths and areas need to improve.
+- Overall Rating: a single number from 0 to 100, computed by applying the above weights
+
+Output **only** the following JSON object (no extra text), with all strings properly escaped:
+
+{
+  "criteria_scores": {
+    "grammar": {"score": <int_0_to_100>, "justification": "<string>"},
+    "relevancy_and_cohesion": {"score": <int_0_to_100>, "justification": "<string>"},
+    "clarity_and_content_development_with_respect_to_title": {"score": <int_0_to_100>, "justification": "<string>"},
+    "sentence_formation": {"score": <int_0_to_100>, "justification": "<string>"},
+    "formatting": {"score": <int_0_to_100>, "justification": "<string>"}
+  },
+  "word_count": <int_word_count>,
+  "overall_feedback": "<string>",
+  "overall_rating": <int_0_to_100>
+}
+"""
+# Per-essay user content; the rubric above travels as the system instruction
+ESSAY_PROMPT_TEMPLATE = """
+The essay title is: "{title}"
+The essay content (in Markdown) is:
+---
+{essay_markdown}
+---
+"""
+# Response schemas (OpenAPI subset) enforced by Gemini on top of JSON mode, mirroring the rubric's
+# output format: a single assessment object, or for batches an array of them tagged with "idx"
+ESSAY_CRITERIA = ("grammar", "relevancy_and_cohesion", "clarity_and_content_development_with_respect_to_title", "sentence_formation", "formatting")
+_CRITERION_SCORE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"score": {"type": "INTEGER"}, "justification": {"type": "STRING"}},
+    "required": ["score", "justification"],
+}
+ESSAY_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "criteria_scores": {"type": "OBJECT", "properties": {c: _CRITERION_SCORE_SCHEMA for c in ESSAY_CRITERIA}, "required": list(ESSAY_CRITERIA)},
+        "word_count": {"type": "INTEGER"},
+        "overall_feedback": {"type": "STRING"},
+        "overall_rating": {"type": "INTEGER"},
+    },
+    "required": ["criteria_scores", "word_count", "overall_feedback", "overall_rating"],
+}
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {**ESSAY_RESPONSE_SCHEMA,
+              "properties": {**ESSAY_RESPONSE_SCHEMA["properties"], "idx": {"type": "INTEGER"}},
+              "required": ESSAY_RESPONSE_SCHEMA["required"] + ["idx"]},
+}
+GEMINI_TIMEOUT_SECONDS = 60
+# Transient API failures (429 rate limits, 500/503) are retried with exponential backoff
+# (1s, 2s, 4s, ... capped at 8s) for up to GEMINI_RETRY_SECONDS in total before giving up
+GEMINI_RETRY_SECONDS = 90
+GEMINI_RETRY = google_retry.Retry(predicate=google_retry.if_transient_error, initial=1.0, multiplier=2.0, maximum=8.0, timeout=GEMINI_RETRY_SECONDS)
+
+# One configured client per server process: genai.configure() drops the library's cached API
+# clients (and their open connection), so running it at module level redid that on every rerun
+@st.cache_resource(show_spinner=False)
+def get_gemini_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(
+        model_name='gemini-1.5-flash-latest',
+        system_instruction=ESSAY_RUBRIC_INSTRUCTION,
+        generation_config={"response_mime_type": "application/json", "temperature": 0.0}, # Deterministic grading
+    )
+
+# --- Database Connection Pool (PostgreSQL) ---
+# One pool per server process, shared by every session and rerun, so queries reuse
+# already-open connections instead of paying the TCP+TLS+auth handshake each time.
+# Hot statements are PREPAREd once per pooled connection, so Postgres parses and plans them
+# once per connection instead of on every call; callers run them with "EXECUTE name (%s, ...)".
+PREPARED_STATEMENTS = {
+    'auth_user': """
+        SELECT u.id, u.username, u.password_hash, u.user_type, u.college_name,
+               sp.full_name, sp.department, sp.branch, sp.roll_number, sp.email
+        FROM users u
+        LEFT JOIN student_profiles sp ON sp.user_id = u.id
+        WHERE u.username = $1
+    """,
+    'get_profile': "SELECT full_name, department, branch, roll_number, email FROM student_profiles WHERE user_id = $1",
+    'save_profile': """
+        INSERT INTO student_profiles (user_id, full_name, department, branch, roll_number, email)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (user_id) DO UPDATE SET
+            full_name = EXCLUDED.full_name,
+            department = EXCLUDED.department,
+            branch = EXCLUDED.branch,
+            roll_number = EXCLUDED.roll_number,
+            email = EXCLUDED.email
+    """,
+    'insert_essay': """
+        INSERT INTO essays (student_user_id, title, content_markdown, ai_feedback_json)
+        VALUES ($1, $2, $3, $4)
+        RETURNING id, submission_time
+    """,
+    # The listing projects just what the table shows; essay text and full feedback are fetched
+    # per essay by get_essay_detail when a row is opened
+    'get_essays': """
+        SELECT id, title, submission_time, overall_rating_g AS overall_rating,
+               ai_feedback_json->>'overall_feedback' AS overall_feedback,
+               COALESCE(ai_feedback_json->>'status' = 'pending', FALSE) AS feedback_pending
+        FROM essays
+        WHERE student_user_id = $1
+        ORDER BY submission_time DESC
+    """,
+    'get_essay_detail': "SELECT content_markdown, ai_feedback_json FROM essays WHERE id = $1 AND student_user_id = $2",
+}
+
+class PreparingConnection(psycopg2.extensions.connection):
+    # Plain psycopg2 connection that remembers whether PREPARED_STATEMENTS have been set up on it
+    statements_prepared = False
+
+def prepare_statements(conn):
+    # Prepared statements live as long as the server session, i.e. the pooled connection.
+    # Sent as one multi-statement string: one round-trip, and Postgres runs it as a single
+    # implicit transaction, so a failure prepares nothing. Returns whether the statements are ready.
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(";".join(f"PREPARE {name} AS {sql}" for name, sql in PREPARED_STATEMENTS.items()))
+        conn.commit()
+        conn.statements_prepared = True
+        return True
+    except (Exception, psycopg2.Error) as e:
+        conn.rollback()
+        logger.warning("Could not prepare statements: %s", e)
+        return False
+
+@st.cache_resource(show_spinner=False)
+def get_db_pool():
+    return psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=10, dsn=st.secrets["DATABASE_URL"],
+                                                connection_factory=PreparingConnection)
 
-# --- Database Connection Function (PostgreSQL) ---
-# Keep the same connection logic, but potentially simplify error display for users
 def get_db_connection():
     try:
-        db_url = st.secrets["DATABASE_URL"]
-        conn = psycopg2.connect(db_url)
+        pool = get_db_pool()
+        conn = pool.getconn()
+        if conn.closed: # Server dropped it while idle in the pool; discard and take a fresh one
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
         return conn
     except Exception as e:
         # Log the detailed error, but show a simpler message to the user
-        print(f"DB Connection Error: {e}")
+        logger.error("DB Connection Error: %s", e)
         st.error("🚨 Could not connect to the database. Please contact support if this persists.")
         return None
 
-# --- Database Initialization Function (PostgreSQL) ---
-def initialize_database_schema():
-    print(f"[{datetime.now()}] Attempting to initialize PostgreSQL schema...") # For logs
-    conn = None
+def release_db_connection(conn):
+    # Hand the connection back to the pool (the pool rolls back any open transaction)
+    if conn is None: return
+    try:
+        get_db_pool().putconn(conn)
+    except Exception as e:
+        logger.error("DB Release Error: %s", e)
+
+def discard_db_connection(conn):
+    # Close the connection instead of pooling it again; the pool opens a fresh one when needed
+    try:
+        get_db_pool().putconn(conn, close=True)
+    except Exception as e:
+        logger.error("DB Discard Error: %s", e)
+
+@contextmanager
+def db_cursor(dict_cursor=False, prepare=True, name=None):
+    # Yields a cursor on a pooled connection (or None if no connection could be made)
+    # and always returns the connection to the pool, even when the body raises.
+    # prepare=False skips PREPARED_STATEMENTS (the schema check runs before the tables exist).
+    # A name makes it a server-side cursor that streams rows in chunks of cursor.itersize.
+    # Plain cursors run in autocommit: every action here is a single statement, so it skips the
+    # BEGIN/COMMIT round-trips, and a read no longer leaves a transaction for putconn to roll
+    # back. Named cursors need a transaction, which the pool rolls back on return.
+    conn = get_db_connection()
+    if conn is not None and prepare and not conn.statements_prepared and not prepare_statements(conn):
+        # Every EXECUTE on this connection would fail, so it is dropped rather than handed out
+        discard_db_connection(conn)
+        conn = None
+    if conn is None:
+        yield None
+        return
     cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            # If connection fails, get_db_connection already shows error, just print log
-            print("DB connection failed in schema initialization.")
-            return
-
-        cursor = conn.cursor()
-        # Schema creation remains the same - it's robust
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                user_type TEXT NOT NULL CHECK(user_type IN ('student', 'college_admin', 'super_admin')),
-                college_name TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS student_profiles (
-                user_id INTEGER PRIMARY KEY, -- This links to users.id
-                full_name TEXT NOT NULL,
-                department TEXT NOT NULL,
-                branch TEXT, -- Nullable
-                roll_number TEXT, -- Nullable
-                email TEXT, -- Nullable
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS essays (
-                id SERIAL PRIMARY KEY,
-                student_user_id INTEGER NOT NULL, -- This links to users.id
-                title TEXT NOT NULL,
-                content_markdown TEXT NOT NULL,
-                submission_time TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                ai_feedback_json JSONB,
-                overall_rating REAL, -- Nullable
-                FOREIGN KEY (student_user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        conn.commit()
-        print(f"[{datetime.now()}] PostgreSQL schema creation/check committed.")
+        conn.autocommit = name is None
+        cursor = conn.cursor(name=name, cursor_factory=psycopg2.extras.RealDictCursor) if dict_cursor else conn.cursor(name=name)
+        yield cursor
+    finally:
+        if cursor: cursor.close()
+        release_db_connection(conn)
+
+# --- Password Hashing ---
+# New passwords are hashed with argon2id; accounts created before the switch still hold
+# werkzeug hashes ("pbkdf2:..."/"scrypt:...") and are verified through werkzeug.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64*1024, parallelism=2)
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def verify_password(stored_hash, password):
+    if stored_hash.startswith("$argon2"):
+        try:
+            return password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError): # VerifyMismatchError is a VerificationError
+            return False
+    return check_password_hash(stored_hash, password)
+
+def password_needs_rehash(stored_hash):
+    # Legacy werkzeug hashes (pbkdf2 at 600k iterations costs far more than argon2 here) and
+    # argon2 hashes made with older parameters are upgraded after the next successful login
+    return not stored_hash.startswith("$argon2") or password_hasher.check_needs_rehash(stored_hash)
+
+def upgrade_password_hash(user_id, password):
+    new_hash = hash_password(password) # Hashed before a pooled connection is borrowed
+    try:
+        with db_cursor() as cursor:
+            if cursor is None: return
+            cursor.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_hash, user_id))
+            logger.info("Upgraded password hash for user_id %s", user_id)
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error upgrading password hash for user_id %s: %s", user_id, error) # Login still succeeds
+
+# --- Database Initialization Function (PostgreSQL) ---
+# Advisory lock key serializing schema setup across server processes/replicas
+SCHEMA_LOCK_KEY = 4242
+# Newest object the schema batch creates; once it exists, every earlier statement has run too
+SCHEMA_LATEST_OBJECT = 'public.idx_essays_overall_rating_g'
 
-        # Add default super_admin if not exists
-        cursor.execute("SELECT id FROM users WHERE username = %s", ('mainadmin',))
-        if cursor.fetchone() is None:
-            cursor.execute("INSERT INTO users (username, password_hash, user_type, college_name) VALUES (%s, %s, %s, %s)",
-                           ('mainadmin', generate_password_hash('superpassword123'), 'super_admin', None))
-            conn.commit()
-            print(f"[{datetime.now()}] Default super_admin added to PostgreSQL.")
+def initialize_database_schema():
+    logger.info("Attempting to initialize PostgreSQL schema...")
+    try:
+        with db_cursor(prepare=False) as cursor:
+            if cursor is None:
+                # If connection fails, get_db_connection already shows error, just print log
+                logger.error("DB connection failed in schema initialization.")
+                return False
+
+            # Already-migrated databases cost one catalog lookup and take no locks
+            cursor.execute("SELECT to_regclass(%s)", (SCHEMA_LATEST_OBJECT,))
+            if cursor.fetchone()[0] is not None:
+                logger.info("PostgreSQL schema already up to date.")
+                return True
+            default_admin_hash = hash_password('superpassword123') # Only stored if mainadmin doesn't exist yet
+
+            # The whole schema goes to Postgres as one multi-statement execute: one round-trip
+            # instead of one per CREATE/ALTER, and the default super_admin is an idempotent insert.
+            # Postgres runs a multi-statement string as a single implicit transaction (even in
+            # autocommit), so it applies all-or-nothing. Concurrent first starts queue on the
+            # transaction-scoped advisory lock at its head instead of racing on CREATE TABLE.
+            # overall_rating_g is derived from the stored feedback by Postgres, so the rating can never
+            # drift from the JSON; non-numeric ratings (e.g. error feedback) simply yield NULL.
+            # The legacy overall_rating column is kept for old rows but no longer written.
+            # Indexes matching the hot read paths:
+            # - get_student_essays: WHERE student_user_id = ? ORDER BY submission_time DESC
+            # - get_college_reports_filtered: WHERE college_name = ? AND user_type = 'student' (partial index)
+            cursor.execute('''
+                SELECT pg_advisory_xact_lock(%s);
+                CREATE TABLE IF NOT EXISTS users (
+                    id SERIAL PRIMARY KEY,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    user_type TEXT NOT NULL CHECK(user_type IN ('student', 'college_admin', 'super_admin')),
+                    college_name TEXT
+                );
+                CREATE TABLE IF NOT EXISTS student_profiles (
+                    user_id INTEGER PRIMARY KEY, -- This links to users.id
+                    full_name TEXT NOT NULL,
+                    department TEXT NOT NULL,
+                    branch TEXT, -- Nullable
+                    roll_number TEXT, -- Nullable
+                    email TEXT, -- Nullable
+                    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                );
+                CREATE TABLE IF NOT EXISTS essays (
+                    id SERIAL PRIMARY KEY,
+                    student_user_id INTEGER NOT NULL, -- This links to users.id
+                    title TEXT NOT NULL,
+                    content_markdown TEXT NOT NULL,
+                    submission_time TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    ai_feedback_json JSONB,
+                    overall_rating REAL, -- Nullable
+                    FOREIGN KEY (student_user_id) REFERENCES users (id) ON DELETE CASCADE
+                );
+                ALTER TABLE essays ADD COLUMN IF NOT EXISTS overall_rating_g REAL GENERATED ALWAYS AS (
+                    CASE WHEN jsonb_typeof(ai_feedback_json->'overall_rating') = 'number'
+                         THEN (ai_feedback_json->>'overall_rating')::real END
+                ) STORED;
+                CREATE INDEX IF NOT EXISTS idx_essays_student_time ON essays (student_user_id, submission_time DESC);
+                CREATE INDEX IF NOT EXISTS idx_users_college_type ON users (college_name, user_type) WHERE user_type = 'student';
+                CREATE INDEX IF NOT EXISTS idx_essays_overall_rating_g ON essays (overall_rating_g);
+                INSERT INTO users (username, password_hash, user_type, college_name)
+                    VALUES (%s, %s, 'super_admin', NULL) ON CONFLICT (username) DO NOTHING;
+            ''', (SCHEMA_LOCK_KEY, 'mainadmin', default_admin_hash))
+            logger.info("PostgreSQL schema creation/check committed.") # One implicit transaction
+
+            if cursor.rowcount: logger.info("Default super_admin added to PostgreSQL.") # rowcount of the final INSERT
+            return True
 
     except (Exception, psycopg2.Error) as error:
         # Log detailed error for debugging, but show simpler message to user (or rely on conn error)
-        print(f"PostgreSQL initialization error: {error}")
+        logger.error("PostgreSQL initialization error: %s", error)
         # st.error("🚨 Initial database setup failed.") # Can uncomment if needed
+        return False
     finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
-        print(f"[{datetime.now()}] PostgreSQL initialization routine finished.")
+        logger.info("PostgreSQL initialization routine finished.")
+
+# --- Execute schema initialization (once per server process) ---
+# cache_resource is shared by every session, so new visitors no longer pay the connect and
+# CREATE/ALTER round-trips. A failed run raises, and Streamlit doesn't cache exceptions,
+# so the next rerun retries instead of pinning the failure for the life of the process.
+@st.cache_resource(show_spinner=False)
+def ensure_database_schema():
+    if not initialize_database_schema():
+        raise RuntimeError("PostgreSQL schema initialization failed.")
+    return True
 
-# --- Execute schema initialization (conditionally, once per app session/process) ---
-# This check is important for efficiency, but the init function itself handles idempotency
-if 'db_schema_initialized' not in st.session_state:
-    initialize_database_schema()
-    st.session_state.db_schema_initialized = True
+try:
+    ensure_database_schema()
+except RuntimeError as error:
+    logger.error("%s Will retry on the next rerun.", error)
 
 # --- Authentication and User Data Functions (DEFINED BEFORE AI & UI) ---
 
+STUDENT_PROFILE_FIELDS = ('full_name', 'department', 'branch', 'roll_number', 'email')
+
 def create_user(username, password, user_type, college_name=None):
     sql = "INSERT INTO users (username, password_hash, user_type, college_name) VALUES (%s, %s, %s, %s)"
-    conn = None
-    cursor = None
+    password_hash = hash_password(password) # CPU-bound; done before borrowing a pooled connection
     try:
-        conn = get_db_connection();
-        if conn is None: return False, "Database error during user creation." # Simplified error
-        cursor = conn.cursor()
-        cursor.execute(sql, (username, generate_password_hash(password), user_type, college_name))
-        conn.commit()
-        print(f"[{datetime.now()}] User created successfully: {username}")
-        return True, "Account created successfully. Please log in." # Simplified success message
+        with db_cursor() as cursor:
+            if cursor is None: return False, "Database error during user creation." # Simplified error
+            cursor.execute(sql, (username, password_hash, user_type, college_name))
+            logger.info("User created successfully: %s", username)
+            return True, "Account created successfully. Please log in." # Simplified success message
     except (Exception, psycopg2.Error) as error:
-        print(f"Error creating user {username}: {error}") # Log detailed error
+        logger.error("Error creating user %s: %s", username, error) # Log detailed error
         if isinstance(error, psycopg2.IntegrityError) and "users_username_key" in str(error).lower():
              return False, "Username already exists."
         return False, f"An error occurred during account creation." # Simplified generic error
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
 
 def authenticate_user(username, password):
-    conn = None
-    cursor = None
-    # print(f"[{datetime.now()}] Attempting authentication for user: {username}") # Debug print
     try:
-        conn = get_db_connection();
-        if conn is None:
-            # print(f"[{datetime.now()}] Auth failed: get_db_connection returned None.") # Debug print
-            # get_db_connection already shows error, no need to repeat
-            return
-        # print(f"[{datetime.now()}] Auth: Database connection successful.") # Debug print
-
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # print(f"[{datetime.now()}] Auth: Cursor created. Executing query for user {username}...") # Debug print
-        # *** FIX APPLIED HERE: Added 'username' to the SELECT list ***
-        cursor.execute("SELECT id, username, password_hash, user_type, college_name FROM users WHERE username = %s", (username,))
-        user_record = cursor.fetchone() # Returns a DictRow or None
-        # print(f"[{datetime.now()}] Auth: Query executed. user_record: {user_record}") # Debug print
+        with db_cursor(dict_cursor=True) as cursor:
+            if cursor is None:
+                # get_db_connection already shows error, no need to repeat
+                return
+
+            # *** FIX APPLIED HERE: Added 'username' to the SELECT list ***
+            # The student profile is joined in so the pages after login don't need a second round-trip
+            cursor.execute("EXECUTE auth_user (%s)", (username,))
+            user_record = cursor.fetchone() # Returns a RealDictRow or None
 
+        # The connection is back in the pool before any session-state work or st.rerun()
         if user_record:
-            # print(f"[{datetime.now()}] Auth: User record found. Checking password hash...") # Debug print
-            if check_password_hash(user_record['password_hash'], password):
-                # print(f"[{datetime.now()}] Auth: Password hash matched! Setting session state...") # Debug print
+            if verify_password(user_record['password_hash'], password):
+                if password_needs_rehash(user_record['password_hash']):
+                    upgrade_password_hash(user_record['id'], password)
                 st.session_state.logged_in = True
                 st.session_state.user_type = user_record['user_type']
                 # Access username from the fetched record using the column name
                 st.session_state.current_username = user_record.get('username')
                 st.session_state.current_user_id = user_record['id']
                 st.session_state.current_college_name = user_record.get('college_name')
+                # Profile columns are all NULL when the LEFT JOIN found no profile row
+                login_profile = {field: user_record[field] for field in STUDENT_PROFILE_FIELDS}
+                st.session_state.student_profile = login_profile if any(v is not None for v in login_profile.values()) else None
 
                 # After successful login, determine the next view based on user type
-                # print(f"[{datetime.now()}] Auth: User type is {st.session_state.user_type}. Determining next view...") # Debug print
                 if st.session_state.user_type == 'student':
                      # Students go directly to the essay writing page after login
                      st.session_state.view = 'student_essay'
                      # Reset essay state on successful login & redirect to essay
                      st.session_state.essay_started = False
-                     st.session_state.timer_start_time = None
+                     st.session_state.essay_deadline = None
                      st.session_state.essay_title_input = ""
-                     st.session_state.essay_content_html = ""
                      st.session_state.pop('profile_page_loaded', None) # Clear profile flag on login
-                     # print(f"[{datetime.now()}] Auth: Redirecting student to essay view.") # Debug print
                 else:
                     st.session_state.view = 'dashboard' # Admins go to general dashboard view
-                    # print(f"[{datetime.now()}] Auth: Redirecting admin to dashboard view.") # Debug print
 
                 st.success(f"Logged in successfully!") # Simplified success message
                 # The actual welcome message with username is in the sidebar UI logic
-                print(f"[{datetime.now()}] User {username} logged in successfully. Session User ID: {st.session_state.current_user_id}") # Debug print
+                logger.info("User %s logged in successfully. Session User ID: %s", username, st.session_state.current_user_id)
                 st.rerun() # This triggers a script rerun
 
             else:
-                # print(f"[{datetime.now()}] Auth failed: Password hash did NOT match for user {username}.") # Debug print
                 st.error("Invalid username or password") # Keep this user feedback
         else:
-             # print(f"[{datetime.now()}] Auth failed: User record NOT found for username {username}.") # Debug print
              st.error("Invalid username or password") # Keep this user feedback
 
     except (Exception, psycopg2.Error) as error:
-        print(f"[{datetime.now()}] Auth Error for user {username}: {error}") # Log detailed error
+        logger.error("Auth Error for user %s: %s", username, error) # Log detailed error
         st.error(f"An authentication error occurred. Please try again.") # Simplified user error
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
-        # print(f"[{datetime.now()}] Authentication routine finished for user {username}.") # Debug print
 
 
 def get_student_profile(user_id):
     if user_id is None:
-        print(f"[{datetime.now()}] get_student_profile called with user_id = None. This should ideally not happen after login.") # Debug print
+        logger.warning("get_student_profile called with user_id = None. This should ideally not happen after login.")
         return None # Return None if user_id is unexpectedly missing
-    conn = None
-    cursor = None
+    # Serve the logged-in user's profile from the session (filled by the login JOIN) when we have it
+    if 'student_profile' in st.session_state and st.session_state.get('current_user_id') == user_id:
+        return st.session_state.student_profile
     try:
-        conn = get_db_connection();
-        if conn is None: return None
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute("SELECT full_name, department, branch, roll_number, email FROM student_profiles WHERE user_id = %s", (user_id,))
-        profile = cursor.fetchone() # Returns a DictRow or None
-        # print(f"[{datetime.now()}] Fetched student profile for user {user_id}: {profile}") # Debug print
-        return profile
+        with db_cursor(dict_cursor=True) as cursor:
+            if cursor is None: return None
+            cursor.execute("EXECUTE get_profile (%s)", (user_id,))
+            profile = cursor.fetchone() # Returns a RealDictRow or None
+            return profile # A dict already (RealDictCursor), same shape as the session copy
     except (Exception, psycopg2.Error) as error:
-        print(f"Error getting student profile for user {user_id}: {error}") # Log detailed error
+        logger.error("Error getting student profile for user %s: %s", user_id, error) # Log detailed error
         # Do not show error to user here, just return None
         return None
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
 
 def save_student_profile(user_id, full_name, department, branch, roll_number, email):
     if user_id is None:
-        print(f"[{datetime.now()}] save_student_profile called with user_id = None. This is unexpected.") # Debug print
+        logger.warning("save_student_profile called with user_id = None. This is unexpected.")
         st.error("Could not save profile: User session issue. Please try logging out and in again.") # Simplified user error
         return False
-    sql = """
-        INSERT INTO student_profiles (user_id, full_name, department, branch, roll_number, email)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET
-            full_name = EXCLUDED.full_name,
-            department = EXCLUDED.department,
-            branch = EXCLUDED.branch,
-            roll_number = EXCLUDED.roll_number,
-            email = EXCLUDED.email;
-    """
-    conn = None
-    cursor = None
+    sql = "EXECUTE save_profile (%s, %s, %s, %s, %s, %s)" # Upsert, see PREPARED_STATEMENTS
     try:
-        conn = get_db_connection();
-        if conn is None:
-            st.error("Failed to save profile: Database connection error.") # Keep this for user feedback
-            return False
-        cursor = conn.cursor()
-        cursor.execute(sql, (user_id, full_name, department, branch, roll_number, email))
-        conn.commit()
-        print(f"[{datetime.now()}] Student profile saved/updated for user_id: {user_id}") # Debug print
+        with db_cursor() as cursor:
+            if cursor is None:
+                st.error("Failed to save profile: Database connection error.") # Keep this for user feedback
+                return False
+            cursor.execute(sql, (user_id, full_name, department, branch, roll_number, email))
+            logger.debug("Student profile saved/updated for user_id: %s", user_id)
+        # Keep the session copy in step with what was just written
+        if st.session_state.get('current_user_id') == user_id:
+            st.session_state.student_profile = dict(zip(STUDENT_PROFILE_FIELDS, (full_name, department, branch, roll_number, email)))
         return True
     except (Exception, psycopg2.Error) as error:
-        print(f"[{datetime.now()}] Error saving student profile for user_id {user_id}: {error}") # Log detailed error
+        logger.error("Error saving student profile for user_id %s: %s", user_id, error) # Log detailed error
         st.error("Failed to save profile due to an internal error.") # Simplified user error
         return False
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
 
-def save_essay_submission(student_user_id, title, content_markdown, ai_feedback_json_str, overall_rating):
+def save_essay_submission(student_user_id, title, content_markdown, ai_feedback_data):
     """
-    Inserts a new essay record into the essays table.
+    Inserts a new essay record into the essays table; submission_time comes from the column DEFAULT
+    and the rating (overall_rating_g) is generated from ai_feedback_data by Postgres.
+    Returns the new essay id on success (and records it in st.session_state.last_submission), False on failure.
     """
     if student_user_id is None:
-         print(f"[{datetime.now()}] save_essay_submission called with student_user_id = None.")
+         logger.warning("save_essay_submission called with student_user_id = None.")
          st.error("Cannot save essay: User ID is not available. Please log out and log in again.")
          return False # Indicate failure
-    sql = """
-        INSERT INTO essays (student_user_id, title, content_markdown, submission_time, ai_feedback_json, overall_rating)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """
-    conn = None
-    cursor = None
-    submission_time_val = datetime.now()
+    sql = "EXECUTE insert_essay (%s, %s, %s, %s)" # INSERT ... RETURNING id, submission_time
     try:
-        conn = get_db_connection();
-        if conn is None:
-            st.error("Failed to save essay: Database connection error.")
-            return False # Indicate failure
-        cursor = conn.cursor()
-        db_overall_rating = overall_rating if isinstance(overall_rating, (int, float)) else None
-        cursor.execute(sql, (student_user_id, title, content_markdown, submission_time_val, ai_feedback_json_str, db_overall_rating))
-        conn.commit()
-        print(f"[{datetime.now()}] Essay saved successfully for user {student_user_id}")
-        return True # Indicate success
+        with db_cursor() as cursor:
+            if cursor is None:
+                st.error("Failed to save essay: Database connection error.")
+                return False # Indicate failure
+            cursor.execute(sql, (student_user_id, title, content_markdown, psycopg2.extras.Json(ai_feedback_data)))
+            essay_id, submission_time = cursor.fetchone()
+            logger.debug("Essay saved successfully for user %s", student_user_id)
+        bump_student_essays_version(student_user_id)
+        # Lets the dashboard confirm the submission without looking it up again
+        st.session_state.last_submission = {'id': essay_id, 'title': title, 'submission_time': submission_time}
+        return essay_id # Indicate success
     except (Exception, psycopg2.Error) as error:
         st.error("Failed to save essay submission.")
-        print(f"Error saving essay for user {student_user_id}: {error}")
+        logger.error("Error saving essay for user %s: %s", student_user_id, error)
         return False # Indicate failure
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+
+def update_essay_feedback(essay_id, ai_feedback_data):
+    # Fills in the AI feedback of an essay that was saved as pending; runs on the grading worker,
+    # so failures are only logged (there is no page to show them on)
+    sql = "UPDATE essays SET ai_feedback_json = %s WHERE id = %s RETURNING student_user_id"
+    try:
+        with db_cursor() as cursor:
+            if cursor is None: return False
+            cursor.execute(sql, (psycopg2.extras.Json(ai_feedback_data), essay_id))
+            updated = cursor.fetchone()
+            logger.debug("AI feedback stored for essay %s", essay_id)
+        if updated: bump_student_essays_version(updated[0])
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error storing AI feedback for essay %s: %s", essay_id, error)
+        return False
+
+@st.cache_resource(show_spinner=False)
+def get_student_essays_versions():
+    # Process-wide {student_user_id: version}; bumped whenever one of the student's essays is
+    # inserted or graded, so get_student_essays' cache needs no DB round-trip to stay fresh
+    return {}
+
+def bump_student_essays_version(student_user_id):
+    get_student_essays_versions()[student_user_id] = time.monotonic_ns()
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _cached_student_essays(student_user_id, version):
+    # `version` is only part of the cache key. Failures raise, so they are never cached.
+    with db_cursor(dict_cursor=True) as cursor:
+        if cursor is None: raise ConnectionError("No database connection.")
+        cursor.execute("EXECUTE get_essays (%s)", (student_user_id,))
+        return cursor.fetchall() # RealDictCursor rows are already dicts
 
 def get_student_essays(student_user_id):
+    # Listing rows only: id, title, submission_time, overall_rating, overall_feedback, feedback_pending
     if student_user_id is None: return [] # Return empty list if user_id is missing
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection();
-        if conn is None: return []
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute('''
-            SELECT id, title, content_markdown, submission_time, ai_feedback_json, overall_rating
-            FROM essays
-            WHERE student_user_id = %s
-            ORDER BY submission_time DESC
-        ''', (student_user_id,))
-        essays = [dict(row) for row in cursor.fetchall()]
-        # print(f"[{datetime.now()}] Fetched {len(essays)} essays for user {student_user_id}.") # Debug print
-        return essays
+        return _cached_student_essays(student_user_id, get_student_essays_versions().get(student_user_id))
     except (Exception, psycopg2.Error) as error:
-        print(f"Error getting student essays for user {student_user_id}: {error}") # Log detailed error
+        logger.error("Error getting student essays for user %s: %s", student_user_id, error) # Log detailed error
         return [] # Return empty list on error
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
 
-def get_college_reports(college_name):
-    # This function is primarily for admin roles, less focus on simplifying user-facing messages here
-    conn = None
-    cursor = None
-    sql_query = '''
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_essay_detail(essay_id, student_user_id, version):
+    # Same per-student version as the listing, so a graded essay's new feedback shows up at once
+    with db_cursor(dict_cursor=True) as cursor:
+        if cursor is None: raise ConnectionError("No database connection.")
+        cursor.execute("EXECUTE get_essay_detail (%s, %s)", (essay_id, student_user_id))
+        return cursor.fetchone()
+
+def get_essay_detail(essay_id, student_user_id):
+    # {'content_markdown', 'ai_feedback_json'} for one of the student's essays, or None
+    try:
+        return _cached_essay_detail(essay_id, student_user_id, get_student_essays_versions().get(student_user_id))
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error getting essay %s for user %s: %s", essay_id, student_user_id, error)
+        return None
+
+# Essays whose assessment failed and is worth retrying; too-short essays also carry an "error",
+# but re-grading can never change their result
+FAILED_FEEDBACK_SQL = "e.ai_feedback_json ? 'error' AND e.ai_feedback_json->>'status' IS DISTINCT FROM 'too_short'"
+
+def get_college_reports_stamp(college_name):
+    # Cheap freshness stamp for get_college_reports_filtered's cache: changes when an essay is added
+    # or removed, when a pending essay gets its background feedback, or when a failed one is re-graded.
+    # Returns (latest submission, essay count, pending count, failed count).
+    sql_query = f'''
+        SELECT MAX(e.submission_time), COUNT(*), COUNT(*) FILTER (WHERE e.ai_feedback_json->>'status' = 'pending'),
+               COUNT(*) FILTER (WHERE {FAILED_FEEDBACK_SQL})
+        FROM essays e
+        JOIN users u ON e.student_user_id = u.id
+        WHERE u.college_name = %s AND u.user_type = 'student'
+    '''
+    try:
+        with db_cursor() as cursor:
+            if cursor is None: return None
+            cursor.execute(sql_query, (college_name,))
+            return tuple(cursor.fetchone())
+    except (Exception, psycopg2.Error) as error:
+        logger.error("SQL Error in get_college_reports_stamp for %s: %s", college_name, error) # Log detailed error
+        return None
+
+REPORT_STRING_COLUMNS = ['student_full_name', 'student_username', 'student_department', 'student_branch', 'student_roll_number']
+REPORT_CATEGORY_COLUMNS = ['student_department', 'student_branch'] # Low-cardinality subset of the above
+# Fixed leading columns of the Excel export, in order: report column -> export header
+REPORT_EXPORT_COLUMNS = {
+    'student_full_name': 'Full Name',
+    'student_department': 'Department',
+    'student_branch': 'Branch',
+    'student_roll_number': 'Roll Number',
+    'student_username': 'Username',
+    'essay_title': 'Essay Title',
+    'submission_time': 'Submission Datetime',
+    'overall_rating': 'Overall Rating (0-100)',
+}
+REPORTS_PAGE_SIZE = 100 # Reports rendered per page on the admin dashboard
+# Sort options offered on the admin dashboard -> ORDER BY expressions (whitelisted, never user text)
+REPORT_SORT_COLUMNS = {
+    "Submission Time": ["e.submission_time"],
+    "Student Name": ["sp.full_name", "u.username"],
+    "Essay Title": ["e.title"],
+    "Overall Rating": ["COALESCE(e.overall_rating_g, -1)"],
+    "Department": ["sp.department"],
+    "Roll Number": ["sp.roll_number"],
+}
+
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def _cached_college_reports(college_name, stamp=None, name_substr=None, rating_min=0, rating_max=100,
+                            date_start=None, date_end=None, sort_by="Submission Time", ascending=False,
+                            limit=None, offset=0):
+    # The admin filters and sort run in Postgres, so only matching rows (one page of them when `limit`
+    # is given) leave the database. `stamp` (from get_college_reports_stamp) is only part of the cache
+    # key: the query reruns when a college's essays change and is served from memory otherwise.
+    # Failures raise, so they are never cached.
+    # Returns a DataFrame built straight from row tuples streamed off a server-side cursor.
+    conditions = ["u.college_name = %s", "u.user_type = 'student'",
+                  "COALESCE(e.overall_rating_g, -1) BETWEEN %s AND %s"] # Unrated essays count as -1
+    params = [college_name, rating_min, rating_max]
+    if name_substr:
+        name_pattern = "%" + name_substr.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("(sp.full_name ILIKE %s OR u.username ILIKE %s)")
+        params += [name_pattern, name_pattern]
+    if date_start:
+        conditions.append("e.submission_time >= %s")
+        params.append(date_start)
+    if date_end:
+        conditions.append("e.submission_time < %s::date + 1") # Through the end of that day
+        params.append(date_end)
+    direction = "ASC" if ascending else "DESC"
+    order_by = ", ".join(f"{col} {direction} NULLS LAST" for col in REPORT_SORT_COLUMNS.get(sort_by, REPORT_SORT_COLUMNS["Submission Time"]))
+    sql_query = f'''
         SELECT
-            e.id as essay_id, e.title as essay_title, e.submission_time, e.overall_rating, e.ai_feedback_json, e.content_markdown,
+            e.id as essay_id, e.title as essay_title, e.submission_time, e.overall_rating_g as overall_rating, e.ai_feedback_json,
             u.username as student_username, u.college_name,
             sp.full_name as student_full_name,
             sp.department as student_department,
@@ -336,123 +668,219 @@ def get_college_reports(college_name):
         FROM essays e
         JOIN users u ON e.student_user_id = u.id
         LEFT JOIN student_profiles sp ON u.id = sp.user_id
-        WHERE u.college_name = %s AND u.user_type = 'student'
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {order_by}, e.id
+        LIMIT %s OFFSET %s
     '''
+    params += [limit, offset] # LIMIT NULL means no limit
+    with db_cursor(name="college_reports") as cursor:
+        if cursor is None: raise ConnectionError("No database connection.")
+        cursor.itersize = 1000
+        cursor.execute(sql_query, params)
+        rows = list(cursor) # Fetched itersize rows per round-trip
+        reports_df = pd.DataFrame.from_records(rows, columns=[col[0] for col in cursor.description])
+    # Column coercions the admin view relies on, done once per fetch rather than per rerun.
+    # submission_time needs none: psycopg2 returns TIMESTAMP values as datetimes, which
+    # from_records already packs into a datetime64 column.
+    reports_df['overall_rating'] = pd.to_numeric(reports_df['overall_rating'], errors='coerce').fillna(-1)
+    # One typed pass for the profile text columns (students without a profile have NULLs there);
+    # fillna after the cast, so missing values become '' rather than the string 'None'
+    reports_df[REPORT_STRING_COLUMNS] = reports_df[REPORT_STRING_COLUMNS].astype('string').fillna('')
+    # A college has a handful of departments/branches repeated on every row: as categoricals
+    # they are stored once, which shrinks the frame st.cache_data pickles and unpickles per rerun
+    reports_df[REPORT_CATEGORY_COLUMNS] = reports_df[REPORT_CATEGORY_COLUMNS].astype('category')
+    return reports_df
+
+def get_college_reports_filtered(college_name, stamp=None, **filters):
+    # This function is primarily for admin roles, less focus on simplifying user-facing messages here
+    # Returns the reports DataFrame, or None (after showing an error) if it couldn't be fetched
     try:
-        conn = get_db_connection();
-        if conn is None:
-             st.error("Failed to fetch college reports: Database error.") # Keep this for admin
-             return []
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute(sql_query, (college_name,))
-        reports_list = [dict(row) for row in cursor.fetchall()]
-        # print(f"[{datetime.now()}] Fetched {len(reports_list)} college reports for {college_name}.") # Debug print
-        return reports_list
+        return _cached_college_reports(college_name, stamp, **filters)
     except (Exception, psycopg2.Error) as error:
-        print(f"SQL Error in get_college_reports for {college_name}: {error}") # Log detailed error
+        logger.error("SQL Error in get_college_reports_filtered for %s: %s", college_name, error) # Log detailed error
         st.error("Failed to fetch college reports due to an internal error.") # Simplified admin error
+        return None
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_college_essay_content(essay_id, college_name):
+    # An essay's text never changes after submission, so no freshness stamp is needed. Failures raise,
+    # so they are never cached.
+    sql_query = '''
+        SELECT e.content_markdown
+        FROM essays e
+        JOIN users u ON e.student_user_id = u.id
+        WHERE e.id = %s AND u.college_name = %s AND u.user_type = 'student'
+    '''
+    with db_cursor() as cursor:
+        if cursor is None: raise ConnectionError("No database connection.")
+        cursor.execute(sql_query, (essay_id, college_name))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+def get_college_essay_content(essay_id, college_name):
+    # Essay text for the admin report detail view; the report list itself doesn't carry it.
+    # Returns None if the essay isn't in this college or couldn't be fetched.
+    try:
+        return _cached_college_essay_content(essay_id, college_name)
+    except (Exception, psycopg2.Error) as error:
+        logger.error("SQL Error in get_college_essay_content for essay %s: %s", essay_id, error) # Log detailed error
+        return None
+
+def get_college_failed_essays(college_name):
+    # Essays of a college whose stored feedback is an error, for bulk re-grading
+    sql_query = f'''
+        SELECT e.id, e.title, e.content_markdown
+        FROM essays e
+        JOIN users u ON e.student_user_id = u.id
+        WHERE u.college_name = %s AND u.user_type = 'student' AND {FAILED_FEEDBACK_SQL}
+    '''
+    try:
+        with db_cursor(dict_cursor=True) as cursor:
+            if cursor is None: return []
+            cursor.execute(sql_query, (college_name,))
+            return cursor.fetchall() # RealDictCursor rows are already dicts
+    except (Exception, psycopg2.Error) as error:
+        logger.error("SQL Error in get_college_failed_essays for %s: %s", college_name, error) # Log detailed error
         return []
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
 
 # --- Helper Functions ---
 def logout():
-    # Reset all relevant session state variables on logout
-    keys_to_reset = ['logged_in', 'user_type', 'current_username', 'current_user_id',
-                     'current_college_name', 'essay_started', 'timer_start_time',
-                     'essay_title_input', 'essay_content_html', 'view',
-                     'profile_page_loaded'] # Add profile_page_loaded to reset list
-    for key in keys_to_reset:
-        if key in st.session_state:
-            del st.session_state[key]
+    # Drop the whole session in one go (this also clears per-user leftovers such as
+    # last_submission and widget keys); the session-state defaults are re-seeded on the rerun
+    st.session_state.clear()
     st.session_state.logged_in = False # Ensure this is explicitly False
     st.session_state.view = 'login' # Always return to login view
     st.success("Logged out.")
     st.rerun()
 
+@lru_cache(maxsize=64)
+def html_to_markdown(html):
+    # Converts the editor's HTML to Markdown. html2text is a single-pass converter (no
+    # BeautifulSoup tree); a fresh parser per call since HTML2Text keeps state between
+    # handle() calls and sessions run on separate threads. The cache absorbs double-submits.
+    converter = html2text.HTML2Text()
+    converter.body_width = 0 # Don't hard-wrap lines
+    return converter.handle(html)
+
+def feedback_as_dict(ai_feedback_json):
+    # Stored feedback as a dict: JSONB comes back as a dict already; legacy/odd values become {}
+    if isinstance(ai_feedback_json, dict): return ai_feedback_json
+    if not ai_feedback_json: return {}
+    try:
+        parsed = orjson.loads(ai_feedback_json)
+    except (TypeError, orjson.JSONDecodeError):
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+@lru_cache(maxsize=256)
+def criterion_label(criterion):
+    # "thesis_clarity" -> "Thesis Clarity"; Gemini returns the same handful of criteria every time
+    return criterion.replace('_', ' ').title()
+
+def fmt_rating(*candidates):
+    # First numeric candidate as a whole-number string, else "N/A"
+    for candidate in candidates:
+        if isinstance(candidate, (int, float)): return f"{candidate:.0f}"
+    return "N/A"
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def parse_essay_record(ai_feedback_json):
+    # Display artefacts for one opened essay: (feedback_data, chart_records).
+    # Keyed on the stored feedback only, so reruns skip re-parsing and re-building the chart.
+    if not ai_feedback_json: feedback_data = {"error": "Feedback data not available."}
+    else: # JSONB already arrives as a dict; legacy text rows go through orjson
+        feedback_data = feedback_as_dict(ai_feedback_json) or {"error": "Could not parse feedback."}
+
+    # Bar-chart rows as plain records for an inline Altair spec (no DataFrame per essay)
+    chart_records = []
+    criteria_scores_data = feedback_data.get('criteria_scores') if not feedback_data.get("error") else None
+    if criteria_scores_data and isinstance(criteria_scores_data, dict):
+        chart_records = [{"Criterion": criterion_label(criterion),
+                          "Score": details.get('score', 0) if isinstance(details.get('score', 0), (int, float)) else 0}
+                         for criterion, details in criteria_scores_data.items()]
+    return feedback_data, chart_records
+
+# Latin-1 punctuation/whitespace -> "_" for download file names (str.translate runs in C); other
+# characters pass through, which only differs from isalnum() for non-Latin-1 non-letters
+FILENAME_SAFE_TABLE = str.maketrans({c: "_" for c in map(chr, range(256)) if not c.isalnum()})
+
+def dataframe_digest(df):
+    # Content hash of a DataFrame (values + column names), computed column-wise in C by pandas
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values.tobytes()
+    return hashlib.blake2b(row_hashes + "\x1f".join(map(str, df.columns)).encode(), digest_size=16).hexdigest()
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_excel_report(df_digest, _df_for_export):
+    # Reruns that don't change the filtered report reuse the workbook bytes; the frame itself is
+    # underscore-prefixed so only its cheap digest is hashed as the cache key
+    excel_buffer = io.BytesIO()
+    with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer: # Write-only engine, faster than openpyxl
+        _df_for_export.to_excel(writer, index=False, sheet_name='Student Reports')
+    return excel_buffer.getvalue()
+
+_WORD_RE = re.compile(r"\S+")
+
 def calculate_word_count(text):
-    return len(text.split()) if text else 0
+    # Counts matches off a C-level iterator instead of materialising text.split()'s token list
+    return sum(1 for _ in _WORD_RE.finditer(text)) if text else 0
 
-# --- AI Logic Functions (DEFINED BEFORE UI SECTIONS, BELOW AUTH FUNCTIONS) ---
-def get_gemini_assessment(title, essay_markdown):
-    prompt = f"""
-    You are an Excellent Writter and Copywrite Expert which has 20 years of experience in writing essays. You are specialized in evaluating student essays. You given a Title and Essay in Markdown format below, Asses Students Essay in Right manner.
-    The essay title is: "{title}"
-    The essay content (in Markdown) is:
-    ---
-    {essay_markdown}
-    ---
-    Please assess the essay based on the following five criteria. For each, give a score from 0 to 100 (0 = very poor, 100 = excellent) and a brief justification:
-
-    1. Grammar (20%): spelling, punctuation, sentence structure, mechanics of Writting. 
-    2. Relevancy and Cohesion with Title (25%): how well the content stays on topic mentioned  and flows logically relative to the title.  
-    3. Clarity and Content Development with respect to Title (25%): depth of ideas present in content, supporting evidence, originality, and clarity with relate to the title.  
-    4. Sentence Formation (20%): variety and complexity of sentence structures, conciseness. 
-    5. Formatting (10%): appropriate Markdown usage (headings, lists, blockquotes) and overall readability and Presentation.
-
-    After scoring, also provide:
-    - Overall Word Count  
-    - Overall Feedback: a concise summary (4 to 6 sentences) of the essays main strengths and areas need to improve. 
-    - Overall Rating: a single number from 0 to 100, computed by applying the above weights  
-
-    Output **only** the following JSON object (no extra text), with all strings properly escaped:
-
-    {{
-      "criteria_scores": {{
-        "grammar": {{"score": <int_0_to_100>, "justification": "<string>"}},
-        "relevancy_and_cohesion": {{"score": <int_0_to_100>, "justification": "<string>"}},
-        "clarity_and_content_development_with_respect_to_title": {{"score": <int_0_to_100>, "justification": "<string>"}},
-        "sentence_formation": {{"score": <int_0_to_100>, "justification": "<string>"}},
-        "formatting": {{"score": <int_0_to_100>, "justification": "<string>"}}
-      }},
-      "word_count": <int_word_count>,
-      "overall_feedback": "<string>",
-      "overall_rating": <int_0_to_100>
-    }}
-    """
-    response = gemini_model.generate_content(prompt)
-    response_text = response.text if hasattr(response, 'text') else ''
-    # JSON extraction logic unchanged...
+# Tags and named entities (&nbsp; etc.) in the editor's HTML; each becomes a word break
+_HTML_MARKUP_RE = re.compile(r"<[^>]+>|&[a-z]+;")
 
-    response = gemini_model.generate_content(prompt)
-    # …rest of your parsing logic…
+@lru_cache(maxsize=8)
+def html_word_count(html):
+    # Live word count straight off the editor HTML: one regex pass instead of a full
+    # HTML -> Markdown conversion on every editor rerun. Cached so reruns that didn't
+    # change the draft (checkbox, fragment hand-offs) reuse the last count.
+    return calculate_word_count(_HTML_MARKUP_RE.sub(" ", html)) if html else 0
+
+# --- AI Logic Functions (DEFINED BEFORE UI SECTIONS, BELOW AUTH FUNCTIONS) ---
+# Fallback stored when the editor HTML can't be converted; get_gemini_assessment doesn't send it to Gemini
+MARKDOWN_CONVERSION_FALLBACK = "<i>Error converting content.</i>"
+# Size bounds on what gets converted, graded and stored: a pasted novel would otherwise cost
+# tokens/latency linear in its size, and essays this short aren't worth a Gemini call at all
+MAX_ESSAY_CHARS = 20_000
+MAX_ESSAY_HTML_CHARS = MAX_ESSAY_CHARS * 4 # Editor HTML carries tag overhead on top of the text
+ESSAY_TRUNCATION_MARKER = "\n\n[... truncated for length ...]"
+# What an untouched/cleared Quill editor reports; a set lookup instead of compares + a .strip() copy
+_EMPTY_QUILL_HTML = frozenset(("", "<p><br></p>", "<p></p>", "<p><br/></p>"))
+MIN_ESSAY_WORDS = 50
+# Stored for essays under MIN_ESSAY_WORDS; the status marks it as final, so it isn't offered for re-grading
+TOO_SHORT_FEEDBACK = {"error": f"Essay is too short to assess (fewer than {MIN_ESSAY_WORDS} words).", "status": "too_short"}
+
+def _run_gemini_assessment(title, essay_markdown):
+    # Uncached Gemini call + response parsing; always returns a dict (error dicts carry an "error" key)
+    prompt = ESSAY_PROMPT_TEMPLATE.format(title=title, essay_markdown=essay_markdown)
 
     response = None # Initialize response to None
     response_text = None # Initialize response_text to None
 
     try:
-        response = gemini_model.generate_content(prompt) # This is the line that might raise an error before assigning to response
+        response = get_gemini_model().generate_content(prompt, generation_config={"response_schema": ESSAY_RESPONSE_SCHEMA},
+                                                       request_options={"timeout": GEMINI_TIMEOUT_SECONDS, "retry": GEMINI_RETRY}) # This is the line that might raise an error before assigning to response
         response_text = response.text # This line might also fail if response doesn't have .text
 
-        # Keep the JSON parsing logic the same - it seems robust
+        # JSON response mode returns a bare JSON object, so no code-fence stripping or brace hunting
         if response_text is not None: # Add a check here before trying to parse
-            if response_text.strip().startswith("```json"):
-                response_text = response_text.strip()[7:-3].strip()
-            elif response_text.strip().startswith("```"):
-                 response_text = response_text.strip()[3:-3].strip()
-            json_start_index = response_text.find('{')
-            json_end_index = response_text.rfind('}') + 1
-            if json_start_index != -1 and json_end_index != -1 :
-                json_string = response_text[json_start_index:json_end_index]
-                parsed_response = json.loads(json_string)
+            parsed_response = orjson.loads(response_text) # orjson.JSONDecodeError subclasses json.JSONDecodeError
+            if isinstance(parsed_response, dict):
                 return parsed_response
             else:
-                print(f"AI Response JSON parse failure. Raw: {response_text}") # Log raw response
+                logger.error("AI Response JSON parse failure. Raw: %s", response_text) # Log raw response
                 return {"error": "AI feedback format issue.", "raw_response": response_text} # Simplified error
         else:
-             print("AI Response text was None.") # Log this unexpected state
+             logger.error("AI Response text was None.") # Log this unexpected state
              return {"error": "AI response text is empty or missing."}
 
     except json.JSONDecodeError as e:
         # This block is reached if JSON decoding fails *after* response_text is assigned
-        print(f"Error decoding JSON from AI: {e}. Raw response: {response_text}") # response_text should be available here
+        logger.error("Error decoding JSON from AI: %s. Raw response: %s", e, response_text) # response_text should be available here
         raw_resp_info = response_text if response_text is not None else "Response text was None or unassignable"
         return {"error": f"AI feedback parsing error: {e}", "raw_response": raw_resp_info} # Simplified error
 
     except Exception as e:
         # *** This block is reached for any other exception during generate_content or response.text access ***
-        print(f"Error getting assessment from Gemini: {e}") # Log detailed error
+        logger.error("Error getting assessment from Gemini: %s", e) # Log detailed error
         error_details = str(e)
         raw_resp_info = "Could not get raw response due to an early error."
 
@@ -460,17 +888,180 @@ def get_gemini_assessment(title, essay_markdown):
         if response is not None:
             error_details = f"AI API error: {str(e)}"
             if hasattr(response, 'prompt_feedback'): # Check for prompt feedback attribute
-                 print(f"Gemini API Prompt Feedback: {response.prompt_feedback}") # Log prompt feedback
+                 logger.error("Gemini API Prompt Feedback: %s", response.prompt_feedback) # Log prompt feedback
                  error_details += f" | Prompt Feedback: {response.prompt_feedback}"
             if hasattr(response, 'text'): # Check if the response object has text
                  raw_resp_info = response.text
 
         return {"error": error_details, "raw_response": raw_resp_info} # Simplified error with details
 
+class _AssessmentFailed(Exception):
+    # Carries an error result out of _cached_gemini so st.cache_data doesn't store it
+    def __init__(self, result):
+        super().__init__(result.get("error"))
+        self.result = result
+
+@st.cache_data(ttl=24*3600, max_entries=512, show_spinner=False)
+def _cached_gemini(content_key, _title, _essay_markdown):
+    # Streamlit doesn't hash underscore-prefixed args, so only the short content_key
+    # digest is hashed/stored as the cache key instead of the whole essay body.
+    result = _run_gemini_assessment(_title, _essay_markdown)
+    if "error" in result:
+        raise _AssessmentFailed(result)
+    return result
+
+def ungradable_essay_feedback(essay_markdown):
+    # The result for an essay that isn't sent to Gemini at all, or None if it should be assessed.
+    # Shared by the single and batch paths so both give the same reason.
+    if essay_markdown == MARKDOWN_CONVERSION_FALLBACK: # Checked first: it would otherwise read as "too short"
+        return {"error": "The essay's formatting could not be converted, so it was not assessed."}
+    if calculate_word_count(essay_markdown) < MIN_ESSAY_WORDS:
+        return dict(TOO_SHORT_FEEDBACK)
+    return None
+
+def get_gemini_assessment(title, essay_markdown):
+    # Identical (title, essay) resubmissions are answered from the cache; errors are never cached
+    ungradable = ungradable_essay_feedback(essay_markdown)
+    if ungradable: return ungradable
+    content_key = hashlib.blake2b((title + "\x1f" + essay_markdown).encode(), digest_size=16).hexdigest()
+    try:
+        return _cached_gemini(content_key, title, essay_markdown)
+    except _AssessmentFailed as failed:
+        return failed.result
+
+# --- Batch assessment (admin re-grading) ---
+# Several essays per Gemini call, so re-grading a cohort pays one round-trip per batch
+# instead of one per essay. Results are matched back to essays by "idx".
+GEMINI_BATCH_SIZE = 5
+GEMINI_BATCH_WORKERS = 4
+BATCH_PROMPT_HEADER = """
+Assess each of the following {count} essays independently against the rubric.
+Respond with a JSON array containing exactly one object per essay. Each object has the
+structure described above plus an integer "idx" field copying the essay's idx.
+"""
+BATCH_ESSAY_HEADER = "=== Essay idx {idx} ==="
+
+def _run_gemini_batch(batch):
+    # batch is a list of (idx, title, essay_markdown); returns {idx: result dict} for every idx
+    prompt = BATCH_PROMPT_HEADER.format(count=len(batch)) + "".join(
+        BATCH_ESSAY_HEADER.format(idx=idx) + ESSAY_PROMPT_TEMPLATE.format(title=title, essay_markdown=essay_markdown)
+        for idx, title, essay_markdown in batch)
+    # Batches carry several essays' worth of output, so allow each essay its own timeout budget
+    try:
+        response = get_gemini_model().generate_content(prompt, generation_config={"response_schema": BATCH_RESPONSE_SCHEMA},
+                                                       request_options={"timeout": GEMINI_TIMEOUT_SECONDS * len(batch), "retry": GEMINI_RETRY})
+        parsed_response = orjson.loads(response.text)
+    except Exception as e: # Includes orjson.JSONDecodeError
+        logger.error("Error getting batch assessment from Gemini: %s", e)
+        return {idx: {"error": f"AI batch assessment error: {e}"} for idx, _, _ in batch}
+
+    results = {}
+    if isinstance(parsed_response, list):
+        for item in parsed_response:
+            if isinstance(item, dict) and item.get("idx") in {idx for idx, _, _ in batch}:
+                results[item.pop("idx")] = item
+    for idx, _, _ in batch:
+        if idx not in results:
+            results[idx] = {"error": "AI batch response did not include this essay."}
+    return results
+
+def batch_gemini_assessment(essays):
+    """
+    Assesses a list of (title, essay_markdown) pairs, GEMINI_BATCH_SIZE essays per Gemini call
+    with up to GEMINI_BATCH_WORKERS calls in flight. Returns one result dict per essay, in order;
+    like get_gemini_assessment, failures come back as dicts with an "error" key.
+    """
+    results = {}
+    to_assess = []
+    for idx, (title, essay_markdown) in enumerate(essays):
+        ungradable = ungradable_essay_feedback(essay_markdown)
+        if ungradable: results[idx] = ungradable
+        else:
+            to_assess.append((idx, title, essay_markdown))
+    batches = [to_assess[i:i + GEMINI_BATCH_SIZE] for i in range(0, len(to_assess), GEMINI_BATCH_SIZE)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=GEMINI_BATCH_WORKERS, thread_name_prefix="essay-batch") as pool:
+            for batch_results in pool.map(_run_gemini_batch, batches):
+                results.update(batch_results)
+    return [results[idx] for idx in range(len(essays))]
+
 
-def process_and_submit_essay(student_user_id, title, essay_content_html_param): # Renamed parameter
+def feedback_for_storage(ai_feedback_data):
+    """
+    Returns the dictionary stored as an essay's ai_feedback_json for a get_gemini_assessment()
+    result. Invalid results are stored as error dictionaries.
+    """
+    if not isinstance(ai_feedback_data, dict):
+        # get_gemini_assessment did not return a dictionary (e.g., returned None unexpectedly)
+        logger.error("get_gemini_assessment did not return a dictionary. Returned: %r", ai_feedback_data)
+        return {"error": "AI feedback data is not a valid structure or was None."}
+    return ai_feedback_data
+
+# --- Deferred Grading (background worker) ---
+# By default essays are saved as "pending" and graded on a process-wide worker pool, so the
+# submitting student is sent straight to the dashboard instead of waiting on Gemini.
+PENDING_FEEDBACK = {"status": "pending"}
+
+@st.cache_resource(show_spinner=False)
+def get_grading_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="essay-grader")
+
+@st.cache_resource(show_spinner=False)
+def get_grading_in_flight():
+    # Ids of essays queued or being graded by this process
+    return set()
+
+# An essay whose feedback couldn't be stored stays pending; it is re-queued with a growing delay
+# and given up on after GRADING_MAX_ATTEMPTS, instead of calling Gemini again on every rerun
+GRADING_MAX_ATTEMPTS = 3
+GRADING_RETRY_DELAY_SECONDS = 60
+
+@st.cache_resource(show_spinner=False)
+def get_grading_failures():
+    # {essay_id: (failed attempts, time.monotonic() before which it isn't re-queued)}
+    return {}
+
+def _grade_essay(essay_id, title, essay_markdown):
+    stored = False
+    try:
+        try:
+            ai_feedback_data = feedback_for_storage(get_gemini_assessment(title, essay_markdown))
+        except Exception as e:
+            # Store the failure, so the essay leaves "pending" and shows up for re-grading
+            logger.error("Background grading failed for essay %s: %s", essay_id, e)
+            ai_feedback_data = {"error": "AI assessment failed unexpectedly."}
+        stored = update_essay_feedback(essay_id, ai_feedback_data)
+    finally:
+        failures = get_grading_failures()
+        if stored: failures.pop(essay_id, None)
+        else:
+            failed_attempts = failures.get(essay_id, (0, 0))[0] + 1
+            failures[essay_id] = (failed_attempts, time.monotonic() + GRADING_RETRY_DELAY_SECONDS * failed_attempts)
+            logger.error("Could not store feedback for essay %s (attempt %s of %s)", essay_id, failed_attempts, GRADING_MAX_ATTEMPTS)
+        get_grading_in_flight().discard(essay_id)
+
+def queue_essay_grading(essay_id, title, essay_markdown):
+    # No-op if this process is already grading the essay, or is backing off / has given up on it
+    in_flight = get_grading_in_flight()
+    if essay_id in in_flight: return
+    failed_attempts, retry_after = get_grading_failures().get(essay_id, (0, 0))
+    if failed_attempts >= GRADING_MAX_ATTEMPTS or time.monotonic() < retry_after: return
+    in_flight.add(essay_id)
+    get_grading_executor().submit(_grade_essay, essay_id, title, essay_markdown)
+
+def is_feedback_pending(feedback_data):
+    return isinstance(feedback_data, dict) and feedback_data.get("status") == PENDING_FEEDBACK["status"]
+
+@st.fragment(run_every=10)
+def watch_pending_feedback(essay_ids):
+    # Polls the worker's in-flight set and reruns the page once these essays are graded
+    if not get_grading_in_flight().intersection(essay_ids):
+        st.rerun()
+
+
+def process_and_submit_essay(student_user_id, title, essay_content_html_param, instant_feedback=False): # Renamed parameter
     if student_user_id is None:
-         print(f"[{datetime.now()}] process_and_submit_essay called with student_user_id = None. This is unexpected.") # Debug print
+         logger.warning("process_and_submit_essay called with student_user_id = None. This is unexpected.")
          st.error("Could not save essay: User session issue. Please try logging out and in again.") # Simplified user error
          return
     if not title.strip():
@@ -480,86 +1071,317 @@ def process_and_submit_essay(student_user_id, title, essay_content_html_param):
     essay_markdown = ""
     # Ensure content is not just empty HTML tags
     # *** USE THE PARAMETER NAME essay_content_html_param consistently ***
-    if essay_content_html_param and essay_content_html_param != "<p><br></p>" and essay_content_html_param.strip() != "<p></p>":
+    if essay_content_html_param and essay_content_html_param not in _EMPTY_QUILL_HTML:
+        if len(essay_content_html_param) > MAX_ESSAY_HTML_CHARS:
+            st.warning(f"Your essay is very long; only about the first {MAX_ESSAY_CHARS:,} characters will be submitted.")
+            essay_content_html_param = essay_content_html_param[:MAX_ESSAY_HTML_CHARS]
         try:
-            essay_markdown = md(essay_content_html_param)
+            essay_markdown = html_to_markdown(essay_content_html_param)
         except Exception as e_md:
-            print(f"Error converting essay content to Markdown: {e_md}") # Log error
-            essay_markdown = "<i>Error converting content.</i>" # Basic fallback
+            logger.error("Error converting essay content to Markdown: %s", e_md) # Log error
+            essay_markdown = MARKDOWN_CONVERSION_FALLBACK # Basic fallback
             st.warning("Could not process essay formatting, submitting as plain text.") # User feedback
     else:
         st.warning("Essay content cannot be empty for submission.") # Keep this user feedback
         return
+    if len(essay_markdown) > MAX_ESSAY_CHARS:
+        essay_markdown = essay_markdown[:MAX_ESSAY_CHARS] + ESSAY_TRUNCATION_MARKER
 
-    with st.spinner("⏳ Evaluating and submitting your essay..."):
-        # get_gemini_assessment is defined before this function
-        ai_feedback_data = get_gemini_assessment(title, essay_markdown)
-        print(f"[{datetime.now()}] DEBUG: Result from get_gemini_assessment: {ai_feedback_data}") # Debug print
-
-    ai_feedback_json_str = None # Initialize to None
-    overall_rating = None # Initialize to None
-
-    if isinstance(ai_feedback_data, dict):
-        print(f"[{datetime.now()}] DEBUG: AI feedback data is a dict.") # Debug print
-        # Always attempt to dump the dictionary to JSON string
-        try:
-             ai_feedback_json_str = json.dumps(ai_feedback_data)
-             print(f"[{datetime.now()}] DEBUG: Dumped AI feedback data to JSON string.") # Debug print
-        except Exception as e:
-             print(f"[{datetime.now()}] ERROR: Could not dump AI feedback dict to JSON string: {e}")
-             ai_feedback_json_str = json.dumps({"error": f"Internal error dumping feedback: {e}"})
-             st.error("⚠️ Internal error preparing AI feedback for saving.")
-
+    if instant_feedback:
+        with st.spinner("⏳ Evaluating and submitting your essay..."):
+            # get_gemini_assessment is defined before this function
+            ai_feedback_data = get_gemini_assessment(title, essay_markdown)
+            logger.debug("Result from get_gemini_assessment: %s", ai_feedback_data)
 
-        if "error" not in ai_feedback_data:
-            overall_rating = ai_feedback_data.get("overall_rating")
-            print(f"[{datetime.now()}] DEBUG: AI feedback data has no 'error'. Overall rating: {overall_rating}") # Debug print
+        if isinstance(ai_feedback_data, dict) and "error" not in ai_feedback_data:
             st.success("🎉 Essay submitted and assessed successfully!")
             st.balloons()
         else:
-            # AI returned an error dictionary
-            print(f"[{datetime.now()}] DEBUG: AI feedback data contains 'error': {ai_feedback_data.get('error')}") # Debug print
             st.error("⚠️ There was an issue processing the AI feedback. Your essay was saved, but feedback may be missing.") # Simplified feedback error
-            # ai_feedback_json_str is already set to the dumped error dictionary above
-    else:
-        # get_gemini_assessment did not return a dictionary (e.g., returned None unexpectedly)
-        print(f"[{datetime.now()}] ERROR: get_gemini_assessment did not return a dictionary. Returned: {ai_feedback_data}") # Debug print
-        ai_feedback_json_str = json.dumps({"error": "AI feedback data is not a valid structure or was None."})
-        st.error("⚠️ An unexpected issue occurred with AI feedback. Your essay was saved, but feedback may be missing.")
 
-
-    # Save the essay regardless of AI feedback success, if content and title are valid
-    # save_essay_submission is now defined BEFORE this function
-    # Removed the callable check as it seems to be part of the issue, relying on definition order
-    print(f"[{datetime.now()}] DEBUG: Calling save_essay_submission...") # Debug print
-    save_essay_submission(student_user_id, title, essay_markdown, ai_feedback_json_str, overall_rating)
-    print(f"[{datetime.now()}] DEBUG: save_essay_submission called.") # Debug print
+        # Save the essay regardless of AI feedback success, if content and title are valid
+        save_essay_submission(student_user_id, title, essay_markdown, feedback_for_storage(ai_feedback_data))
+    else:
+        # Save now as pending; the grading worker fills in the feedback
+        essay_id = save_essay_submission(student_user_id, title, essay_markdown, PENDING_FEEDBACK)
+        if essay_id:
+            queue_essay_grading(essay_id, title, essay_markdown)
+            st.success("🎉 Essay submitted! Your AI feedback will appear in Past Submissions shortly.")
 
 
     # Reset state for next essay
     st.session_state.essay_started = False
-    st.session_state.timer_start_time = None
+    st.session_state.essay_deadline = None
     st.session_state.essay_title_input = ""
-    st.session_state.essay_content_html = ""
     # Redirect to student dashboard to see past submissions
     st.session_state.view = 'student_dashboard'
     st.rerun() # Rerun to update the view
 
 
+# --- College Admin Dashboard ---
+# A fragment: filter/sort/paging widgets rerun only this function, not the sidebar and view routing
+@st.fragment
+def render_college_dashboard(college_name):
+    st.subheader("📊 Student Essay Reports")
+    with st.container(border=True):
+        st.markdown("#### Filter & Sort Options")
+        cols_filter_sort1 = st.columns([1,1])
+        with cols_filter_sort1[0]:
+            sort_by = st.selectbox("Sort by", options=["Submission Time", "Student Name", "Essay Title", "Overall Rating", "Department", "Roll Number"], index=0, key="college_sort_by")
+        with cols_filter_sort1[1]:
+            sort_order_str = st.radio("Order", ["Descending", "Ascending"], index=0, horizontal=True, key="college_sort_order")
+            sort_ascending = True if sort_order_str == "Ascending" else False
+        cols_filter_sort2 = st.columns([1,2])
+        with cols_filter_sort2[0]:
+            filter_student_name = st.text_input("Filter by Student Name/Username", key="college_filter_name", placeholder="Type name...")
+        with cols_filter_sort2[1]:
+            filter_rating_min, filter_rating_max = st.slider("Filter by Overall Rating", 0, 100, (0, 100), key="college_filter_rating")
+        cols_date_filter = st.columns(2)
+        with cols_date_filter[0]:
+            filter_date_start = st.date_input("Submissions From", value=None, key="college_filter_date_start")
+        with cols_date_filter[1]:
+            filter_date_end = st.date_input("Submissions To", value=None, key="college_filter_date_end")
+    st.markdown("---")
+    reports_stamp = get_college_reports_stamp(college_name)
+    # Essays whose stored feedback is an error (e.g., Gemini timed out) can be re-graded in bulk
+    failed_count = reports_stamp[3] if reports_stamp else 0
+    if failed_count:
+        with st.container(border=True):
+            st.markdown("#### 🔁 Re-grade Failed Essays")
+            st.caption(f"{failed_count} essay(s) have no AI feedback because their assessment failed.")
+            if st.button("Re-grade failed essays", key="college_regrade_failed"):
+                failed_essays = get_college_failed_essays(college_name)
+                with st.spinner(f"⏳ Re-grading {len(failed_essays)} essay(s)..."):
+                    regraded = batch_gemini_assessment([(r.get('title') or '', r.get('content_markdown') or '') for r in failed_essays])
+                    for failed_essay, ai_feedback_data in zip(failed_essays, regraded):
+                        update_essay_feedback(failed_essay['id'], feedback_for_storage(ai_feedback_data))
+                st.rerun(scope="fragment") # The stamp's failed count changes, so the reports refetch
+    if reports_stamp and not reports_stamp[1]:
+        st.info(f"ℹ️ No student submissions found yet for {college_name}.")
+    else:
+        # Filters and sort are applied by Postgres; the export gets every match, the list one page of them
+        report_filters = dict(name_substr=filter_student_name.strip() or None, rating_min=filter_rating_min, rating_max=filter_rating_max,
+                              date_start=filter_date_start, date_end=filter_date_end, sort_by=sort_by, ascending=sort_ascending)
+        export_ready_df = get_college_reports_filtered(college_name, reports_stamp, **report_filters)
+        if export_ready_df is None: return # The error is already shown; the next rerun retries the query
+        if not export_ready_df.empty:
+            with st.container(border=True):
+                st.markdown("#### 📄 Export Report")
+                # The workbook is only built on request; the prepared file is kept for exactly the
+                # report it was made from (stamp + filters), so changing a filter hides a stale one
+                export_key = (reports_stamp, tuple(report_filters.items()))
+                if st.button("🔧 Prepare Excel", key="college_prepare_excel", use_container_width=True):
+                    # Column-wise build: feedback parsed once per row, criteria flattened by json_normalize
+                    export_feedback = export_ready_df['ai_feedback_json'].map(feedback_as_dict)
+                    criteria_scores = export_feedback.map(lambda fb: fb.get('criteria_scores') if isinstance(fb.get('criteria_scores'), dict) else {})
+                    criteria_df = pd.json_normalize(criteria_scores.tolist()).set_axis(export_ready_df.index) # "<criterion>.score", "<criterion>.justification"
+                    score_cols = [col for col in criteria_df.columns if col.endswith('.score')]
+                    scores_df = criteria_df[score_cols].rename(columns=lambda col: criterion_label(col[:-len('.score')]) + " Score (0-10)")
+                    df_for_export = export_ready_df[list(REPORT_EXPORT_COLUMNS)].rename(columns=REPORT_EXPORT_COLUMNS)
+                    export_rating = df_for_export['Overall Rating (0-100)'].astype(object)
+                    df_for_export['Overall Rating (0-100)'] = export_rating.where(export_rating != -1, "Not Rated")
+                    df_for_export = df_for_export.join(scores_df) # Per-criterion score columns go after the fixed ones
+                    try:
+                        excel_bytes = build_excel_report(dataframe_digest(df_for_export), df_for_export)
+                        college_name_safe = (college_name or "UnknownCollege").translate(FILENAME_SAFE_TABLE)
+                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                        st.session_state.college_excel_export = {'key': export_key, 'data': excel_bytes,
+                                                                 'file_name': f"student_reports_{college_name_safe}_{timestamp}.xlsx"}
+                    except Exception as e_excel: st.error(f"Error generating Excel file: {e_excel}")
+                prepared_export = st.session_state.get('college_excel_export')
+                if prepared_export and prepared_export['key'] == export_key:
+                    st.download_button(label="📥 Download Excel", data=prepared_export['data'], file_name=prepared_export['file_name'], mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True, type="primary")
+        total_matches = len(export_ready_df)
+        report_pages = max(1, -(-total_matches // REPORTS_PAGE_SIZE))
+        if st.session_state.get("college_report_page", 1) > report_pages:
+            st.session_state.college_report_page = report_pages # Filters narrowed the result set
+        report_page = st.number_input("Page", min_value=1, max_value=report_pages, step=1, key="college_report_page") if report_pages > 1 else 1
+        # The page is a slice of the already filtered and sorted export set: one query, one sort
+        display_df = export_ready_df.iloc[(report_page - 1) * REPORTS_PAGE_SIZE:report_page * REPORTS_PAGE_SIZE]
+        st.markdown("---")
+        if display_df.empty: st.info("ℹ️ No reports match the current filter criteria.")
+        else:
+            st.markdown(f"**Displaying {len(display_df)} of {total_matches} report(s):**")
+            # One table widget for the whole page; details are rendered only for the selected row
+            summary_df = pd.DataFrame({
+                'Student': display_df['student_full_name'].where(display_df['student_full_name'] != '', display_df['student_username']),
+                'Roll Number': display_df['student_roll_number'],
+                'Essay Title': display_df['essay_title'],
+                'Rating': display_df['overall_rating'].where(display_df['overall_rating'] != -1), # Unrated -> empty cell
+                'Submitted': display_df['submission_time'],
+            })
+            report_event = st.dataframe(summary_df, on_select="rerun", selection_mode="single-row", use_container_width=True, hide_index=True, key="college_report_table")
+            if not report_event.selection.rows:
+                st.caption("Select a report in the table to see the essay and its AI feedback.")
+            else:
+                report_item = display_df.iloc[report_event.selection.rows[0]].to_dict()
+                student_name = report_item.get('student_full_name') or report_item.get('student_username', 'N/A')
+                feedback_data = feedback_as_dict(report_item.get('ai_feedback_json')) or {"error": "Feedback data not available."}
+                with st.container(border=True):
+                    st.markdown(f"#### 📄 {report_item.get('essay_title', 'N/A')}")
+                    col_details1, col_details2 = st.columns([1,1])
+                    with col_details1:
+                        st.markdown(f"**Full Name:** {student_name}")
+                        st.markdown(f"**Department:** {report_item.get('student_department', 'N/A')}")
+                        st.markdown(f"**Essay Title:** {report_item.get('essay_title', 'N/A')}")
+                    with col_details2:
+                        st.markdown(f"**Branch:** {report_item.get('student_branch', 'N/A')}")
+                        st.markdown(f"**Roll Number:** {report_item.get('student_roll_number', 'N/A')}")
+                        st.markdown(f"**Submitted:** {report_item.get('submission_time', 'N/A')}")
+                    essay_content = get_college_essay_content(report_item['essay_id'], college_name)
+                    if essay_content is None: st.error("Could not load this essay's content. Please try again.")
+                    else: st.markdown(f"**Submitted Content:**\n```markdown\n{essay_content}\n```")
+                    if feedback_data and not feedback_data.get("error"):
+                        st.markdown("**📝 AI Feedback:**")
+                        st.info(f"**Overall Rating:** {feedback_data.get('overall_rating', 'N/A')}/100 | **Word Count (AI):** {feedback_data.get('word_count', 'N/A')}")
+                        st.markdown(f"**Summary:** {feedback_data.get('overall_feedback', 'No summary.')}")
+                        criteria_scores_data = feedback_data.get('criteria_scores', {})
+                        if criteria_scores_data:
+                            st.markdown("##### Detailed Scores:")
+                            for criterion, details in criteria_scores_data.items():
+                                st.markdown(f"- **{criterion_label(criterion)}:** {details.get('score', 'N/A')}/10 - *{details.get('justification', 'No justification.')}*")
+                    else: st.warning("Feedback not available for this essay.")
+
+
+# --- Student Past Submissions ---
+STUDENT_ESSAYS_PAGE_SIZE = 10
+
+@st.fragment
+def render_student_submissions(student_essays):
+    # One table widget for one page of past essays; the essay, feedback and chart are rendered
+    # only for the selected row, and paging or selecting reruns just this fragment
+    essay_pages = max(1, -(-len(student_essays) // STUDENT_ESSAYS_PAGE_SIZE))
+    if st.session_state.get("student_essays_page", 1) > essay_pages:
+        st.session_state.student_essays_page = essay_pages
+    essays_page = st.number_input("Page", min_value=1, max_value=essay_pages, step=1, key="student_essays_page") if essay_pages > 1 else 1
+    student_essays = student_essays[(essays_page - 1) * STUDENT_ESSAYS_PAGE_SIZE:essays_page * STUDENT_ESSAYS_PAGE_SIZE]
+    titles, submitted, ratings, summaries = [], [], [], []
+    for essay_record in student_essays:
+        # Each listing field is read once; the rows carry no essay text or full feedback
+        title, submission_time, overall_rating, overall_feedback, feedback_pending = (essay_record.get(k) for k in ('title', 'submission_time', 'overall_rating', 'overall_feedback', 'feedback_pending'))
+        titles.append(title or 'N/A')
+        submitted.append(submission_time.strftime('%Y-%m-%d %H:%M') if isinstance(submission_time, datetime) else 'N/A')
+        ratings.append("⏳ Pending" if feedback_pending else fmt_rating(overall_rating)) # overall_rating_g mirrors the feedback's rating
+        summaries.append(overall_feedback or '')
+    summary_df = pd.DataFrame({'Title': titles, 'Submitted': submitted, 'Rating': ratings, 'Summary': summaries})
+    essays_event = st.dataframe(summary_df, on_select="rerun", selection_mode="single-row", use_container_width=True, hide_index=True, key="student_essays_table")
+    if not essays_event.selection.rows or essays_event.selection.rows[0] >= len(student_essays): # Stale selection after the list changed
+        st.caption("Select an essay in the table to see its content and AI feedback.")
+        return
+    selected_row = essays_event.selection.rows[0]
+    essay_detail = get_essay_detail(student_essays[selected_row]['id'], st.session_state.current_user_id)
+    if essay_detail is None:
+        st.error("Could not load this essay. Please try again.")
+        return
+    feedback_data, chart_records = parse_essay_record(essay_detail.get('ai_feedback_json'))
+    with st.container(border=True):
+        st.markdown(f"**Title:** {titles[selected_row]}")
+        st.markdown(f"**Submitted Content (Markdown):**")
+        st.code(essay_detail.get('content_markdown') or '', language="markdown")
+
+        if is_feedback_pending(feedback_data):
+            st.info("⏳ Your essay is being evaluated. Feedback will appear here automatically.")
+        elif feedback_data and not feedback_data.get("error"):
+            st.markdown("**📝 AI Feedback:**")
+            st.info(f"**Overall Rating:** {feedback_data.get('overall_rating', 'N/A')}/100 | **Word Count (AI):** {feedback_data.get('word_count', 'N/A')}")
+            st.markdown(f"**Summary:** {feedback_data.get('overall_feedback', 'No summary provided.')}")
+
+            criteria_scores_data = feedback_data.get('criteria_scores', {})
+            if criteria_scores_data:
+                st.markdown("##### Detailed Scores (Text):")
+                for criterion, details in criteria_scores_data.items():
+                    st.markdown(f"- **{criterion_label(criterion)}:** {details.get('score', 'N/A')}/10 - *{details.get('justification', 'No justification.')}*")
+                st.markdown("##### Detailed Scores (Graphical):")
+                if chart_records:
+                    criteria_chart = alt.Chart(alt.Data(values=chart_records)).mark_bar().encode(x='Criterion:N', y='Score:Q').properties(height=300)
+                    st.altair_chart(criteria_chart, use_container_width=True)
+                else: st.caption("No numerical criteria scores available to plot.")
+            else: st.caption("No detailed criteria scores provided in feedback.")
+        else:
+            st.error(f"AI Feedback Error: {feedback_data.get('error', 'Unknown error')}")
+            if 'raw_response' in feedback_data:
+                with st.expander("Show Raw AI Response"):
+                    st.text_area("Raw AI Response:", feedback_data['raw_response'], height=100, disabled=True)
+            st.warning("Feedback processing pending or not available.")
+
+
+# --- Essay Timer ---
+# The countdown is drawn and ticked by the browser; the server only checks in to hand over to the
+# 1 s ticker for the final stretch and to rerun the page (auto-submit) the moment time runs out.
+ESSAY_TIMER_SLOW_TICK = 15 # Seconds between server checks while more than the final stretch is left
+ESSAY_TIMER_FINAL_STRETCH = 60 # Last seconds, checked every second
+ESSAY_TIMER_HTML = """
+<div style="font-family: sans-serif; font-size: 0.9rem;">
+  <progress id="bar" max="{limit}" value="0" style="width: 100%;"></progress>
+  <div id="left"></div>
+</div>
+<script>
+  const end = Date.now() + {remaining} * 1000, limit = {limit};
+  function tick() {{
+    const left = Math.max(0, Math.round((end - Date.now()) / 1000));
+    document.getElementById("bar").value = limit - left;
+    const el = document.getElementById("left");
+    el.textContent = left > 0 ? "Time Left: " + String(Math.floor(left / 60)).padStart(2, "0") + ":" + String(left % 60).padStart(2, "0") : "Time's Up!";
+    el.style.color = left < 60 ? "#d33" : "inherit"; // Less than a minute remaining
+  }}
+  tick(); setInterval(tick, 1000);
+</script>
+"""
+
+def _essay_timer_body(deadline, time_left_at_page_run):
+    # time_left_at_page_run is what the last full run saw. Crossing into the final stretch reruns
+    # the page once so it swaps in the 1 s ticker; running out reruns it so its time's-up branch
+    # auto-submits the essay.
+    time_remaining = deadline - time.monotonic()
+    if time_remaining > 0:
+        if time_remaining < 60: st.warning("Less than a minute remaining!")
+        if time_remaining <= ESSAY_TIMER_FINAL_STRETCH < time_left_at_page_run:
+            st.rerun(scope="app")
+    else:
+        st.error("Time's Up!")
+        if time_left_at_page_run > 0:
+            st.rerun(scope="app")
+
+# Only the timer fragment reruns on its tick; the editor, word count and the rest of the page don't.
+# run_every is fixed per fragment, hence one slow and one fast ticker.
+@st.fragment(run_every=ESSAY_TIMER_SLOW_TICK)
+def _essay_timer_slow(deadline, time_left_at_page_run):
+    _essay_timer_body(deadline, time_left_at_page_run)
+
+@st.fragment(run_every=1)
+def _essay_timer_fast(deadline, time_left_at_page_run):
+    _essay_timer_body(deadline, time_left_at_page_run)
+
+def essay_timer(deadline, limit_seconds, time_left_at_page_run):
+    # Client-side countdown (re-seeded from the server's monotonic deadline on every full run)
+    components.html(ESSAY_TIMER_HTML.format(limit=int(limit_seconds), remaining=max(0, int(time_left_at_page_run))), height=56)
+    ticker = _essay_timer_fast if time_left_at_page_run <= ESSAY_TIMER_FINAL_STRETCH else _essay_timer_slow
+    ticker(deadline, time_left_at_page_run)
+
+
+# Quill toolbar for the essay editor; a module constant instead of a fresh nested list every rerun
+TOOLBAR_ESSENTIAL = (('bold', 'italic', 'underline'), ({'header': 1}, {'header': 2}, {'header': 3}), ({'list': 'ordered'}, {'list': 'bullet'}), ('blockquote',), ('clean',))
+
 # --- Session State Initialization (for UI state variables) ---
 # Added new views for clearer flow: 'student_profile', 'student_essay', 'student_dashboard'
-if 'view' not in st.session_state: st.session_state.view = 'login'
-if 'logged_in' not in st.session_state: st.session_state.logged_in = False
-if 'user_type' not in st.session_state: st.session_state.user_type = None
-if 'current_username' not in st.session_state: st.session_state.current_username = None
-if 'current_user_id' not in st.session_state: st.session_state.current_user_id = None
-if 'current_college_name' not in st.session_state: st.session_state.current_college_name = None
-if 'essay_title_input' not in st.session_state: st.session_state.essay_title_input = ""
-if 'essay_content_html' not in st.session_state: st.session_state.essay_content_html = ""
-if 'essay_started' not in st.session_state: st.session_state.essay_started = False
-if 'timer_start_time' not in st.session_state: st.session_state.timer_start_time = None
-if 'submission_time_limit_seconds' not in st.session_state: st.session_state.submission_time_limit_seconds = 30 * 60
-if 'profile_page_loaded' not in st.session_state: st.session_state.profile_page_loaded = False
+SESSION_DEFAULTS = {
+    'view': 'login',
+    'logged_in': False,
+    'user_type': None,
+    'current_username': None,
+    'current_user_id': None,
+    'current_college_name': None,
+    'essay_title_input': "",
+    'essay_started': False,
+    'essay_deadline': None,
+    'submission_time_limit_seconds': 30 * 60,
+    'profile_page_loaded': False,
+}
+# Seeded once per session (and again after logout clears the session), not checked key by key every rerun
+if not st.session_state.get('_session_initialized'):
+    for key, default in SESSION_DEFAULTS.items():
+        st.session_state.setdefault(key, default)
+    st.session_state._session_initialized = True
 
 
 # --- UI Sections ---
@@ -570,61 +1392,50 @@ with st.sidebar:
     if st.session_state.logged_in:
         # Welcome message now uses the session state variable
         st.success(f"Welcome, **{st.session_state.get('current_username', 'User')}**!") # Use .get for safety just in case
-        st.info(f"**Role:** {st.session_state.user_type.replace('_', ' ').title()}")
+        # Role and college share one element (markdown line break: two trailing spaces)
+        user_info = f"**Role:** {st.session_state.user_type.replace('_', ' ').title()}"
         if st.session_state.current_college_name:
-            st.write(f"**College:** {st.session_state.current_college_name}")
+            user_info += f"  \n**College:** {st.session_state.current_college_name}"
+        st.info(user_info)
         st.markdown("---")
-        # Sidebar navigation for logged-in users
+        # Sidebar navigation for logged-in users: one radio instead of a button per destination.
+        # Deliberately not keyed, so its selection follows st.session_state.view when a view is
+        # changed elsewhere (login, essay submit, profile edit/save).
         if st.session_state.user_type == 'student':
-             # Student navigation
-             if st.button("👤 View Profile", use_container_width=True, key="nav_view_profile"): # Changed from "Edit Profile"
-                 st.session_state.view = 'student_view_profile' # New view state
-                 st.session_state.pop('profile_page_loaded', None) # Clear flag when navigating to view
-                 st.rerun()
-             if st.button("✍️ Start New Essay", use_container_width=True, key="nav_new_essay"):
-                  st.session_state.view = 'student_essay'
-                  # Reset essay state when navigating to start a new one
-                  st.session_state.essay_started = False
-                  st.session_state.timer_start_time = None
-                  st.session_state.essay_title_input = ""
-                  st.session_state.essay_content_html = ""
-                  st.session_state.pop('profile_page_loaded', None) # Clear flag if navigating away from profile
-                  st.rerun()
-             if st.button("📚 View Past Submissions", use_container_width=True, key="nav_past_submissions"):
-                  st.session_state.view = 'student_dashboard'
-                  st.session_state.pop('profile_page_loaded', None) # Clear flag if navigating away from profile
-                  st.rerun()
-        elif st.session_state.user_type in ['college_admin', 'super_admin']:
-            # Admin navigation
-            if st.button("📊 View Reports", use_container_width=True, key="nav_view_reports"):
-                  st.session_state.view = 'dashboard' # Admins share the main dashboard view
-                  st.session_state.pop('profile_page_loaded', None) # Clear flag if navigating away from profile
-                  st.rerun()
-        # Super Admin specific nav
-        if st.session_state.user_type == 'super_admin':
-             if st.button("👑 Admin Management", use_container_width=True, key="nav_admin_management"):
-                  st.session_state.view = 'super_admin_manage'
-                  st.session_state.pop('profile_page_loaded', None) # Clear flag if navigating away from profile
-                  st.rerun()
+            nav_options = {"👤 View Profile": 'student_view_profile', "✍️ Start New Essay": 'student_essay', "📚 View Past Submissions": 'student_dashboard'}
+        else: # Admins share the main dashboard view for reports
+            nav_options = {"📊 View Reports": 'dashboard'}
+            if st.session_state.user_type == 'super_admin':
+                nav_options["👑 Admin Management"] = 'super_admin_manage'
+        nav_views = list(nav_options.values())
+        nav_choice = st.radio("Navigate", list(nav_options), label_visibility="collapsed",
+                              index=nav_views.index(st.session_state.view) if st.session_state.view in nav_views else None)
+        if nav_choice is not None and nav_options[nav_choice] != st.session_state.view:
+            st.session_state.view = nav_options[nav_choice]
+            st.session_state.pop('profile_page_loaded', None) # Clear flag if navigating away from profile
+            if st.session_state.view == 'student_essay':
+                # Reset essay state when navigating to start a new one
+                st.session_state.essay_started = False
+                st.session_state.essay_deadline = None
+                st.session_state.essay_title_input = ""
+            # No st.rerun(): the main area below reads the new view in this same run
 
         st.markdown("---")
         if st.button("🚪 Logout", key="logout_button_sidebar", use_container_width=True, type="secondary"):
             logout() # logout() already clears profile_page_loaded
     else:
         st.info("Welcome! Please log in or sign up.")
-        # Simplified sidebar buttons for login/signup
+        # Simplified sidebar buttons for login/signup; like the nav radio they switch the view
+        # before the main area renders, so the click's own run already shows the new page
         if st.session_state.view == 'login':
             if st.button("✨ New Student? Sign Up", key="goto_signup_sidebar", use_container_width=True):
                 st.session_state.view = 'signup'
                 st.session_state.pop('profile_page_loaded', None) # Clear flag
-                st.rerun()
         elif st.session_state.view == 'signup':
             if st.button("🔒 Already have an account? Login", key="goto_login_sidebar", use_container_width=True):
                 st.session_state.view = 'login'
                 st.session_state.pop('profile_page_loaded', None) # Clear flag
-                st.rerun()
-    st.markdown("---")
-    st.caption("Powered by Truskill AI Technology")
+    st.caption("---\nPowered by Truskill AI Technology") # Separator and footer in one element
 
 # --- Main Content Area ---
 
@@ -667,18 +1478,18 @@ if not st.session_state.logged_in:
                         else: st.warning("Please fill all fields.")
 
 else: # User is logged in
-    # Fetch profile info *at the start* of the logged-in section for potential use across student views
-    # Admin views don't need profile info, but fetching here is safe
-    student_profile = None
+    # Fetch profile info only for the two student views that show it; the essay and
+    # past-submissions views (the busiest ones) and admin views never look at it
+    student_profile = {} # Always a dict, so the profile views can .get() without type checks
+    profile_incomplete_for_display = True
     # profile_incomplete is no longer used to gate the essay writing page
 
-    if st.session_state.user_type == 'student' and st.session_state.current_user_id is not None:
-         student_profile = get_student_profile(st.session_state.current_user_id)
+    if (st.session_state.user_type == 'student' and st.session_state.current_user_id is not None
+            and st.session_state.view in ('student_profile', 'student_view_profile')):
+         student_profile = get_student_profile(st.session_state.current_user_id) or {}
          # We still calculate profile_incomplete for displaying warnings/info in the profile view
-         profile_incomplete_for_display = True
-         if student_profile is not None and isinstance(student_profile, dict):
-             if student_profile.get('full_name', '').strip() and student_profile.get('department', '').strip():
-                 profile_incomplete_for_display = False
+         if (student_profile.get('full_name') or '').strip() and (student_profile.get('department') or '').strip():
+             profile_incomplete_for_display = False
 
 
     # Simplified Admin Views
@@ -708,7 +1519,7 @@ else: # User is logged in
         elif st.session_state.view == 'dashboard':
              st.header(f"👑 Super Admin: All College Reports")
              st.info("As a Super Admin, you can view reports across all colleges.")
-             # Note: get_college_reports is currently filtered by college_name.
+             # Note: get_college_reports_filtered is currently filtered by college_name.
              # For Super Admin to see *all* reports, you would need a new function
              # like get_all_reports() that doesn't filter by college_name.
              st.warning("Reporting for Super Admin (viewing all colleges) is not fully implemented yet. Showing individual college report view.")
@@ -724,165 +1535,13 @@ else: # User is logged in
         # College Admin always goes to dashboard view
         if st.session_state.view == 'dashboard':
             st.header(f"🎓 College Admin: {st.session_state.current_college_name}")
-            st.subheader("📊 Student Essay Reports")
-            # College Admin report view logic remains the same
-            with st.container(border=True):
-                st.markdown("#### Filter & Sort Options")
-                cols_filter_sort1 = st.columns([1,1])
-                with cols_filter_sort1[0]:
-                    sort_by = st.selectbox("Sort by", options=["Submission Time", "Student Name", "Essay Title", "Overall Rating", "Department", "Roll Number"], index=0, key="college_sort_by")
-                with cols_filter_sort1[1]:
-                    sort_order_str = st.radio("Order", ["Descending", "Ascending"], index=0, horizontal=True, key="college_sort_order")
-                    sort_ascending = True if sort_order_str == "Ascending" else False
-                cols_filter_sort2 = st.columns([1,2])
-                with cols_filter_sort2[0]:
-                    filter_student_name = st.text_input("Filter by Student Name/Username", key="college_filter_name", placeholder="Type name...")
-                with cols_filter_sort2[1]:
-                    filter_rating_min, filter_rating_max = st.slider("Filter by Overall Rating", 0, 100, (0, 100), key="college_filter_rating")
-                cols_date_filter = st.columns(2)
-                with cols_date_filter[0]:
-                    filter_date_start = st.date_input("Submissions From", value=None, key="college_filter_date_start")
-                with cols_date_filter[1]:
-                    filter_date_end = st.date_input("Submissions To", value=None, key="college_filter_date_end")
-            st.markdown("---")
-            all_reports_list = get_college_reports(st.session_state.current_college_name)
-            if not all_reports_list:
-                st.info(f"ℹ️ No student submissions found yet for {st.session_state.current_college_name}.")
-            else:
-                reports_df = pd.DataFrame(all_reports_list)
-                if reports_df.empty:
-                     st.info(f"ℹ️ No student submissions found yet for {st.session_state.current_college_name}.")
-                else:
-                    reports_df['submission_time_dt'] = pd.to_datetime(reports_df['submission_time'], errors='coerce')
-                    reports_df['overall_rating'] = pd.to_numeric(reports_df['overall_rating'], errors='coerce').fillna(-1)
-                    reports_df['student_department'] = reports_df['student_department'].astype(str).fillna('')
-                    reports_df['student_roll_number'] = reports_df['student_roll_number'].astype(str).fillna('')
-                    filtered_df = reports_df.copy()
-                    if filter_student_name:
-                        filtered_df['student_full_name'] = filtered_df['student_full_name'].astype(str).fillna('')
-                        filtered_df['student_username'] = filtered_df['student_username'].astype(str).fillna('')
-                        filtered_df = filtered_df[filtered_df['student_full_name'].str.contains(filter_student_name, case=False, na=False) | filtered_df['student_username'].str.contains(filter_student_name, case=False, na=False)]
-                    filtered_df = filtered_df[(filtered_df['overall_rating'] >= filter_rating_min) & (filtered_df['overall_rating'] <= filter_rating_max)]
-                    export_ready_df = filtered_df.copy()
-                    if filter_date_start: export_ready_df = export_ready_df[export_ready_df['submission_time_dt'].notna() & (export_ready_df['submission_time_dt'].dt.date >= filter_date_start)]
-                    if filter_date_end: export_ready_df = export_ready_df[export_ready_df['submission_time_dt'].notna() & (export_ready_df['submission_time_dt'].dt.date <= filter_date_end)]
-                    sort_column_map = {"Submission Time": "submission_time_dt", "Student Name": "student_full_name", "Essay Title": "essay_title", "Overall Rating": "overall_rating", "Department": "student_department", "Roll Number": "student_roll_number"}
-                    sort_col_actual = sort_column_map.get(sort_by, "submission_time_dt")
-                    display_df = filtered_df.copy()
-                    if sort_col_actual in ["student_full_name", "student_department", "student_roll_number", "essay_title"]:
-                        display_df = display_df.sort_values(by=[sort_col_actual] + (['student_username'] if sort_col_actual == "student_full_name" else []), ascending=sort_ascending, na_position='last')
-                        export_ready_df = export_ready_df.sort_values(by=[sort_col_actual] + (['student_username'] if sort_col_actual == "student_full_name" else []), ascending=sort_ascending, na_position='last')
-                    else:
-                         display_df = display_df.sort_values(by=sort_col_actual, ascending=sort_ascending)
-                         export_ready_df = export_ready_df.sort_values(by=sort_col_actual, ascending=sort_ascending)
-                    if not export_ready_df.empty:
-                        with st.container(border=True):
-                            st.markdown("#### 📄 Export Report")
-                            export_data_list = []
-                            for index, row in export_ready_df.iterrows():
-                                export_row = {'Full Name': row.get('student_full_name', ''),'Department': row.get('student_department', ''),'Branch': row.get('student_branch', ''),'Roll Number': row.get('student_roll_number', ''),'Username': row.get('student_username', ''),'Essay Title': row.get('essay_title', ''),'Submission Datetime': row.get('submission_time', ''),'Overall Rating (0-100)': "Not Rated" if row.get('overall_rating', -1) == -1 else row.get('overall_rating')}
-                                feedback_data_export = {}
-                                ai_feedback_json_export = row.get('ai_feedback_json')
-                                # --- FIX FOR COLLEGE ADMIN EXPORT ---
-                                if ai_feedback_json_export:
-                                    if isinstance(ai_feedback_json_export, dict):
-                                        feedback_data_export = ai_feedback_json_export
-                                    else:
-                                        try:
-                                            feedback_data_export = json.loads(ai_feedback_json_export)
-                                        except (TypeError, json.JSONDecodeError):
-                                            feedback_data_export = {} # Default to empty dict on any parsing error
-                                    criteria_scores = feedback_data_export.get('criteria_scores', {})
-                                    # --- END FIX ---
-                                    if criteria_scores: # Ensure criteria_scores is not empty
-                                        for crit, details in criteria_scores.items():
-                                            crit_name_formatted = crit.replace('_', ' ').title() + " Score (0-10)"
-                                            export_row[crit_name_formatted] = details.get('score', 'N/A')
-                                export_data_list.append(export_row)
-                            df_for_export = pd.DataFrame(export_data_list)
-                            preferred_cols_order = ['Full Name', 'Department', 'Branch', 'Roll Number', 'Username', 'Essay Title', 'Submission Datetime', 'Overall Rating (0-100)']
-                            existing_cols = df_for_export.columns.tolist()
-                            final_export_cols_ordered = [col for col in preferred_cols_order if col in existing_cols]
-                            for col in existing_cols:
-                                if col not in final_export_cols_ordered: final_export_cols_ordered.append(col)
-                            if final_export_cols_ordered: df_for_export = df_for_export[final_export_cols_ordered]
-                            excel_buffer = io.BytesIO()
-                            try:
-                                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer: df_for_export.to_excel(writer, index=False, sheet_name='Student Reports')
-                                excel_buffer.seek(0)
-                                college_name_safe = "".join(c if c.isalnum() else "_" for c in (st.session_state.current_college_name or "UnknownCollege"))
-                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                excel_filename = f"student_reports_{college_name_safe}_{timestamp}.xlsx"
-                                st.download_button(label="📥 Download Excel", data=excel_buffer, file_name=excel_filename, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True, type="primary")
-                            except Exception as e_excel: st.error(f"Error generating Excel file: {e_excel}")
-                    elif not filtered_df.empty and (filter_date_start or filter_date_end): st.info("No reports match selected date period for export.")
-                    st.markdown("---")
-                    if display_df.empty: st.info("ℹ️ No reports match the current filter criteria.")
-                    else:
-                        st.markdown(f"**Displaying {len(display_df)} report(s):**")
-                        for index, report_item_row in display_df.iterrows():
-                            report_item = report_item_row.to_dict()
-                            student_name = report_item.get('student_full_name', report_item.get('student_username', 'N/A'))
-                            department = report_item.get('student_department', "N/A")
-                            roll_number = report_item.get('student_roll_number', "N/A")
-                            feedback_data = {}
-                            ai_feedback_json = report_item.get('ai_feedback_json')
-                            # --- FIX FOR COLLEGE ADMIN DISPLAY ---
-                            if ai_feedback_json:
-                                if isinstance(ai_feedback_json, dict):
-                                    feedback_data = ai_feedback_json
-                                else:
-                                    try:
-                                        feedback_data = json.loads(ai_feedback_json)
-                                    except (TypeError, json.JSONDecodeError):
-                                        feedback_data = {"error": "Could not parse feedback."}
-                            else:
-                                feedback_data = {"error": "Feedback data not available."}
-                            # --- END FIX ---
-
-                            rating_val = report_item.get('overall_rating', -1)
-                            rating_display = "N/A" if rating_val == -1 else f"{rating_val:.0f}"
-                            if isinstance(feedback_data, dict) and 'overall_rating' in feedback_data:
-                                rating_from_feedback = feedback_data.get('overall_rating')
-                                if isinstance(rating_from_feedback, (int, float)): rating_display = f"{rating_from_feedback:.0f}"
-                                elif isinstance(rating, (int,float)): rating = f"{rating:.0f}"
-                            elif isinstance(rating, (int,float)): rating = f"{rating:.0f}"
-
-                            expander_title = f"📄 {student_name} (Roll: {roll_number}) - {report_item.get('essay_title', 'N/A')} (Rating: {rating_display})"
-                            with st.expander(expander_title):
-                                col_details1, col_details2 = st.columns([1,1])
-                                with col_details1:
-                                    st.markdown(f"**Full Name:** {student_name}")
-                                    st.markdown(f"**Department:** {department}")
-                                    st.markdown(f"**Essay Title:** {report_item.get('essay_title', 'N/A')}")
-                                with col_details2:
-                                    st.markdown(f"**Branch:** {report_item.get('student_branch', 'N/A')}")
-                                    st.markdown(f"**Roll Number:** {report_item.get('student_roll_number', 'N/A')}")
-                                    st.markdown(f"**Submitted:** {report_item.get('submission_time', 'N/A')}")
-                                st.markdown(f"**Submitted Content:**\n```markdown\n{report_item.get('content_markdown', '')}\n```")
-                                if feedback_data and not feedback_data.get("error"):
-                                    st.markdown("**📝 AI Feedback:**")
-                                    st.info(f"**Overall Rating:** {feedback_data.get('overall_rating', 'N/A')}/100 | **Word Count (AI):** {feedback_data.get('word_count', 'N/A')}")
-                                    st.markdown(f"**Summary:** {feedback_data.get('overall_feedback', 'No summary.')}")
-                                    criteria_scores_data = feedback_data.get('criteria_scores', {})
-                                    if criteria_scores_data:
-                                        st.markdown("##### Detailed Scores:")
-                                        for criterion, details in criteria_scores_data.items():
-                                            st.markdown(f"- **{criterion.replace('_', ' ').title()}:** {details.get('score', 'N/A')}/10 - *{details.get('justification', 'No justification.')}*")
-                                else: st.warning("Feedback not available for this essay.")
+            render_college_dashboard(st.session_state.current_college_name)
 
 
     elif st.session_state.user_type == 'student':
         # Student flow: Login -> Essay -> Dashboard (Past Submissions) -> Profile (Optional Edit)
-        # Fetch profile info *at the start* of the student section for the profile view and sidebar link
-        student_profile = get_student_profile(st.session_state.current_user_id)
-
-        # profile_incomplete is no longer used to gate the essay writing page.
-        # We only need it for the warning message in the profile edit view.
-        profile_incomplete_for_display = True
-        if student_profile is not None and isinstance(student_profile, dict):
-             if student_profile.get('full_name', '').strip() and student_profile.get('department', '').strip():
-                 profile_incomplete_for_display = False
+        # student_profile and profile_incomplete_for_display were fetched/computed once at the top of
+        # the logged-in section (profile views only); profile_incomplete only drives the edit view's warning.
 
         # --- Manage profile_page_loaded flag to reset widget states ---
         if st.session_state.view == 'student_profile': # Edit Profile Form View
@@ -906,23 +1565,22 @@ else: # User is logged in
              # --- Student View Profile (Read-Only) ---
              st.header(f"👤 Your Profile - {st.session_state.current_college_name}")
              st.markdown("---")
-             # Fetch fresh profile for display
-             current_profile_data = get_student_profile(st.session_state.current_user_id) or {}
+             # Same profile as fetched above (save_student_profile keeps the session copy current)
 
              cols_profile_view = st.columns(2)
              with cols_profile_view[0]:
                  st.markdown(f"**Full Name:**")
-                 st.markdown(f"### {current_profile_data.get('full_name','—')}")
+                 st.markdown(f"### {student_profile.get('full_name','—')}")
                  st.markdown(f"**Department:**")
-                 st.markdown(f"### {current_profile_data.get('department','—')}")
+                 st.markdown(f"### {student_profile.get('department','—')}")
              with cols_profile_view[1]:
                  st.markdown(f"**Branch:**")
-                 st.markdown(f"### {current_profile_data.get('branch','—')}")
+                 st.markdown(f"### {student_profile.get('branch','—')}")
                  st.markdown(f"**Roll Number:**")
-                 st.markdown(f"### {current_profile_data.get('roll_number','—')}")
+                 st.markdown(f"### {student_profile.get('roll_number','—')}")
 
              st.markdown(f"**Email:**")
-             st.markdown(f"### {current_profile_data.get('email','—')}")
+             st.markdown(f"### {student_profile.get('email','—')}")
              st.markdown("---")
              if st.button("✏️ Edit Profile", use_container_width=True, type="primary"):
                  st.session_state.view = 'student_profile' # Switch to edit mode
@@ -942,11 +1600,11 @@ else: # User is logged in
                  st.info("Fields marked with * are required.")
                  with st.form("profile_form_student"):
                     # Populate defaults if profile exists
-                    s_full_name_default = student_profile.get('full_name', '') if student_profile and isinstance(student_profile, dict) else ""
-                    s_department_default = student_profile.get('department', '') if student_profile and isinstance(student_profile, dict) else ""
-                    s_branch_default = student_profile.get('branch', '') if student_profile and isinstance(student_profile, dict) else ""
-                    s_roll_number_default = student_profile.get('roll_number', '') if student_profile and isinstance(student_profile, dict) else ""
-                    s_email_default = student_profile.get('email', '') if student_profile and isinstance(student_profile, dict) else ""
+                    s_full_name_default = student_profile.get('full_name') or ""
+                    s_department_default = student_profile.get('department') or ""
+                    s_branch_default = student_profile.get('branch') or ""
+                    s_roll_number_default = student_profile.get('roll_number') or ""
+                    s_email_default = student_profile.get('email') or ""
 
 
                     s_full_name = st.text_input("Full Name*", value=s_full_name_default, key="profile_full_name", placeholder="Your full name")
@@ -981,15 +1639,16 @@ else: # User is logged in
 
              if not st.session_state.essay_started:
                  # Start New Essay section
-                 with st.container(border=True):
+                 # A form, so typing the title doesn't rerun the page; the title is checked on submit
+                 with st.form("start_essay_form", clear_on_submit=False):
                      st.subheader("Start Your Essay")
-                     st.session_state.essay_title_input = st.text_input("Enter the title of your essay:", value=st.session_state.essay_title_input, key="essay_title_widget_main", placeholder="e.g., The Impact of Renewable Energy")
+                     essay_title = st.text_input("Enter the title of your essay:", value=st.session_state.essay_title_input, placeholder="e.g., The Impact of Renewable Energy")
                      st.markdown("<br>", unsafe_allow_html=True)
-                     if st.button("🚀 Start Writing My Essay!", disabled=(not st.session_state.essay_title_input.strip()), type="primary", use_container_width=True, key="start_essay_btn"):
-                         if st.session_state.essay_title_input.strip():
+                     if st.form_submit_button("🚀 Start Writing My Essay!", type="primary", use_container_width=True):
+                         st.session_state.essay_title_input = essay_title
+                         if essay_title.strip():
                              st.session_state.essay_started = True
-                             st.session_state.timer_start_time = time.time()
-                             st.session_state.essay_content_html = "" # Clear content on start
+                             st.session_state.essay_deadline = time.monotonic() + st.session_state.submission_time_limit_seconds # Monotonic: immune to wall-clock changes
                              st.rerun()
                          else: st.warning("Please enter an essay title.")
 
@@ -997,69 +1656,60 @@ else: # User is logged in
                  # Essay writing in progress section
                  st.subheader(f"⏳ Writing: {st.session_state.essay_title_input}")
                  # ... (Timer calculation and display) ...
-                 time_elapsed = time.time() - st.session_state.timer_start_time
-                 time_remaining = st.session_state.submission_time_limit_seconds - time_elapsed
-                 
+                 time_remaining = st.session_state.essay_deadline - time.monotonic()
+
                  col_timer, col_wc, col_submit = st.columns([2,1,1]) # Define columns
 
                  with col_timer:
-                     if time_remaining > 0:
-                         minutes = int(time_remaining // 60)
-                         seconds = int(time_remaining % 60)
-                         progress_value = time_elapsed / st.session_state.submission_time_limit_seconds
-                         st.progress(progress_value, text=f"Time Left: {minutes:02d}:{seconds:02d}")
-                         if time_remaining < 60: st.warning("Less than a minute remaining!")
-                     else:
-                         st.error("Time's Up!")
-
-                 toolbar_config_essential = [['bold', 'italic', 'underline'], [{'header': 1}, {'header': 2}, {'header': 3}], [{'list': 'ordered'}, {'list': 'bullet'}], ['blockquote'], ['clean']]
+                     essay_timer(st.session_state.essay_deadline, st.session_state.submission_time_limit_seconds, time_remaining)
+
                  st.caption("Use the toolbar below to format your essay.")
 
                  # --- Quill Editor is here ---
+                 # The editor keeps its own content in the browser and only ever mounts on a fresh
+                 # essay, so it gets a constant seed; passing the live HTML back as `value` re-sent the
+                 # whole draft to the browser as component args on every rerun.
                  essay_html_content = st_quill(
-                     value=st.session_state.get("essay_content_html", ""),
+                     value="",
                      placeholder="Compose your brilliant essay here...",
                      html=True,
-                     toolbar=toolbar_config_essential,
+                     toolbar=TOOLBAR_ESSENTIAL,
                      key="quill_editor_main",
                  )
-                 st.session_state.essay_content_html = essay_html_content # Update session state
 
                  # *** WORD COUNT CALCULATION MOVED HERE ***
                  # The columns col_timer, col_wc, col_submit were defined above the timer display
                  with col_wc: # Use the previously defined word count column
-                     temp_markdown_for_wc = md(essay_html_content) if essay_html_content and essay_html_content != "<p><br></p>" and essay_html_content.strip() != "<p></p>" else ""
-                     word_count = calculate_word_count(temp_markdown_for_wc)
+                     word_count = html_word_count(essay_html_content)
                      st.info(f"Words: **{word_count}**")
                  # *** END WORD COUNT CALCULATION ***
 
 
                  submit_button_placeholder = col_submit.empty() # Use the previously defined submit column
+                 col_submit.checkbox("⚡ Instant feedback", key="instant_feedback", help="Wait here for the AI review instead of having it graded in the background.")
 
                  if time_remaining > 0:
                      if submit_button_placeholder.button("✅ Submit Essay", key="manual_submit_student_main", type="primary", use_container_width=True):
                          # process_and_submit_essay takes essay_html_content, so pass it
-                         process_and_submit_essay(st.session_state.current_user_id, st.session_state.essay_title_input, essay_html_content)
+                         process_and_submit_essay(st.session_state.current_user_id, st.session_state.essay_title_input, essay_html_content, instant_feedback=st.session_state.get("instant_feedback", False))
                          # process_and_submit_essay handles rerunning and setting view to 'student_dashboard'
-
-                     # Timer update logic - rerun every second only when writing
-                     # Only rerun if time is still remaining and essay is started
-                     if time_remaining > 0 and st.session_state.essay_started:
-                          time.sleep(1)
-                          st.rerun()
+                     # The clock ticks inside essay_timer, which reruns the page once time runs out
                  else:
                      # Auto-submit when time is up
                      submit_button_placeholder.empty()
                      if st.session_state.essay_started:
                          st.warning("Time's up! Submitting your essay automatically...")
                          # process_and_submit_essay takes essay_html_content, so pass it
-                         process_and_submit_essay(st.session_state.current_user_id, st.session_state.essay_title_input, essay_html_content)
+                         process_and_submit_essay(st.session_state.current_user_id, st.session_state.essay_title_input, essay_html_content, instant_feedback=st.session_state.get("instant_feedback", False))
                          # process_and_submit_essay handles rerunning and setting view to 'student_dashboard'
 
 
         elif st.session_state.view == 'student_dashboard':
              # --- Student Past Submissions Dashboard ---
              st.header("📚 Your Past Submissions")
+             last_submission = st.session_state.pop('last_submission', None)
+             if last_submission:
+                 st.success(f"✅ \"{last_submission['title']}\" was submitted at {last_submission['submission_time'].strftime('%Y-%m-%d %H:%M')}.")
              # Display past essays...
              student_essays = get_student_essays(st.session_state.current_user_id)
              if not student_essays:
@@ -1069,78 +1719,30 @@ else: # User is logged in
                      st.session_state.view = 'student_essay'
                      # Reset essay state when navigating to start a new one
                      st.session_state.essay_started = False
-                     st.session_state.timer_start_time = None
+                     st.session_state.essay_deadline = None
                      st.session_state.essay_title_input = ""
-                     st.session_state.essay_content_html = ""
                      st.session_state.pop('profile_page_loaded', None) # Clear flag
                      st.rerun()
              else:
                  st.markdown("---")
+                 pending_essay_ids = []
                  for essay_record in student_essays:
-                     feedback_data = {}
-                     ai_feedback_json = essay_record.get('ai_feedback_json')
-                     if ai_feedback_json and isinstance(ai_feedback_json, (str, dict)): # Handle potential non-string JSON data
-                         try:
-                             # If it's already a dict (possible from JSONB fetch), use it directly
-                             if isinstance(ai_feedback_json, dict):
-                                 feedback_data = ai_feedback_json
-                             else: # Otherwise, assume it's a JSON string
-                                feedback_data = json.loads(ai_feedback_json)
-                         except json.JSONDecodeError: feedback_data = {"error": "Could not parse feedback."}
-                     else: # Handle case where ai_feedback_json is None or other unexpected type
-                         feedback_data = {"error": "Feedback data not available."}
-
-
-                     rating = essay_record.get('overall_rating') if essay_record.get('overall_rating') is not None else "N/A"
-                     if isinstance(feedback_data, dict) and 'overall_rating' in feedback_data:
-                         rating_from_fb = feedback_data.get('overall_rating')
-                         if isinstance(rating_from_fb, (int, float)): rating = f"{rating_from_fb:.0f}"
-                         elif isinstance(rating, (int,float)): rating = f"{rating:.0f}"
-                     elif isinstance(rating, (int,float)): rating = f"{rating:.0f}"
-
-                     # Format submission time for display
-                     submission_time_display = essay_record.get('submission_time')
-                     if isinstance(submission_time_display, datetime):
-                         submission_time_display = submission_time_display.strftime('%Y-%m-%d %H:%M')
-                     else:
-                         submission_time_display = 'N/A'
-
-
-                     expander_title_past = f"📜 {essay_record.get('title','N/A')} (Submitted: {submission_time_display}) - Rating: {rating}"
-                     with st.expander(expander_title_past):
-                         st.markdown(f"**Title:** {essay_record.get('title','N/A')}")
-                         st.markdown(f"**Submitted Content (Markdown):**")
-                         st.code(essay_record.get('content_markdown',''), language="markdown")
-
-                         if feedback_data and not feedback_data.get("error"):
-                             st.markdown("**📝 AI Feedback:**")
-                             st.info(f"**Overall Rating:** {feedback_data.get('overall_rating', 'N/A')}/100 | **Word Count (AI):** {feedback_data.get('word_count', 'N/A')}")
-                             st.markdown(f"**Summary:** {feedback_data.get('overall_feedback', 'No summary provided.')}")
-
-                             criteria_scores_data = feedback_data.get('criteria_scores', {})
-                             if criteria_scores_data:
-                                 st.markdown("##### Detailed Scores (Text):")
-                                 for criterion, details in criteria_scores_data.items():
-                                      st.markdown(f"- **{criterion.replace('_', ' ').title()}:** {details.get('score', 'N/A')}/10 - *{details.get('justification', 'No justification.')}*")
-                                 st.markdown("##### Detailed Scores (Graphical):")
-                                 chart_data = {}
-                                 for criterion, details in criteria_scores_data.items():
-                                     criterion_name_formatted = criterion.replace('_', ' ').title()
-                                     score_val = details.get('score', 0)
-                                     if isinstance(score_val, (int, float)): chart_data[criterion_name_formatted] = score_val
-                                     else: chart_data[criterion_name_formatted] = 0
-                                 if chart_data:
-                                     df_chart = pd.DataFrame(list(chart_data.items()), columns=['Criterion', 'Score'])
-                                     df_chart = df_chart.set_index('Criterion')
-                                     st.bar_chart(df_chart, height=300, use_container_width=True)
-                                 else: st.caption("No numerical criteria scores available to plot.")
-                             else: st.caption("No detailed criteria scores provided in feedback.")
-                         else:
-                             st.error(f"AI Feedback Error: {feedback_data.get('error', 'Unknown error')}")
-                             if 'raw_response' in feedback_data:
-                                 with st.expander("Show Raw AI Response"):
-                                     st.text_area("Raw AI Response:", feedback_data['raw_response'], height=100, disabled=True)
-                             st.warning("Feedback processing pending or not available.")
+                     if essay_record.get('feedback_pending'):
+                         essay_id = essay_record['id']
+                         pending_essay_ids.append(essay_id)
+                         # Re-queues essays whose grading was lost (e.g., a server restart); no-op if already queued.
+                         # Only pending essays need their text fetched for this. If the fetch fails the essay is
+                         # left for the next rerun: grading it as '' would store a permanent "too short".
+                         if essay_id not in get_grading_in_flight():
+                             essay_detail = get_essay_detail(essay_id, st.session_state.current_user_id)
+                             if essay_detail is not None:
+                                 queue_essay_grading(essay_id, essay_record.get('title',''), essay_detail.get('content_markdown') or '')
+                 render_student_submissions(student_essays)
+                 # Only essays actually being graded are watched: one that is backing off after a failed
+                 # store would otherwise trigger a full rerun every poll
+                 watched_essay_ids = get_grading_in_flight().intersection(pending_essay_ids)
+                 if watched_essay_ids:
+                     watch_pending_feedback(watched_essay_ids)
 
         else:
              # Fallback for unexpected view state for student